@@ -2,7 +2,7 @@
 Simulation of an M|G|1 queue with server breakdowns
 Classes are denoted as class 0, and class 1. Class 0 arrivals belong to the higher priority class and
 represent server breakdowns.
-This nomenclature is used to ensure proper sort, as SimPy prioirty resource sorts on priority
+This nomenclature is used to ensure proper sort, as the simulation kernel serves waiting jobs by priority
 in ascending order. This also makes storing system flow time information intuitive, as Python is 
 zero indexed.
 
@@ -12,15 +12,14 @@ to define a distribution. For testing purposes we utilize exponential, gamma, an
 Service times use logistic distributions in all cases
 """
 
-# import required packages - numpy, scipy, and simpy required to be installed if not present
+# import required packages - numpy and numba required to be installed if not present
 
 import math
 import numpy as np
-import scipy as sp
-import scipy.stats as stats
-import simpy
-import collections
-import csv
+from statistics import NormalDist
+from numba import njit
+from concurrent.futures import ThreadPoolExecutor
+import os
 
 
 '''
@@ -44,6 +43,11 @@ if K < 1:
 if K > 1:
     SHAPE = 1/(K-1) # Shape of Gamma Distribution
     SCALE = (K-1)/MU # Scale of Gamma Distribution
+# resolve the customer service time sampler once rather than checking K in every simulation
+if K == 1:
+    draw_service = lambda rng, size: np.full(size, 1/MU) # Special case for Deterministic system
+else:
+    draw_service = lambda rng, size: rng.gamma(SHAPE,SCALE,size)
 
 
 # Define parameters of server breakdowns
@@ -63,6 +67,18 @@ elif DIST == 2:
     LN_MEAN = math.log(M1**2/math.sqrt(M1**2+M2**2))
     LN_STD = math.log(1+M2**2/M1**2)
 
+# resolve the sampler of on periods once; called with the random number generator and number of deviates to draw
+match DIST:
+    case 1:
+        # Gamma
+        draw_on_times = lambda rng, size: rng.gamma(SHAPE_ARRIN,SCALE_ARRIN,size)
+    case 2:
+        # Log-Normal
+        draw_on_times = lambda rng, size: rng.lognormal(LN_MEAN,LN_STD,size)
+    case _:
+        # Default 0, Exponential
+        draw_on_times = lambda rng, size: rng.exponential(M1,size)
+
 
 LAMBDA_IN = 1/M1 # interarrival rate, equal to 1/mean
 MU_IN = 0.036 # service rate, latitude indipendent, equal to 1/mean service time (based on MST of 27.8026)
@@ -79,6 +95,7 @@ else:
     # define parameters of Logistic distribution for server repair; Numpy uses shape/scale definition
     SHAPE_SERVIN = 1/MU_IN # Shape of Logistic Distribution; corresponds to location/mean
     SCALE_SERVIN = math.sqrt((3*(K_IN-1))/((np.pi*MU_IN)**2)) # Scale of Logistic Distribution; defined directly in terms of Variance
+    CDF0_SERVIN = 1/(1+math.exp(SHAPE_SERVIN/SCALE_SERVIN)) # Logistic CDF at zero; service times are drawn from the distribution truncated to positive support
 
 # define parameters for service distribution times
 
@@ -97,6 +114,8 @@ for l in range(NUMLAM):
 FRAC = 0.1 # fraction of time to wait for before collecting statistics
 ITERATIONS = 30 # number of independent simulations
 ALPHA = 0.05 # confidence interval is 100*(1-alpha) percent
+Z = NormalDist().inv_cdf(1-ALPHA/2) # critical value of the confidence interval
+RSEED = 1869 # base seed for random number generation
 
 
 
@@ -108,159 +127,247 @@ SM_IN = K_IN/(MU_IN**2) #Second moment of server repair time
 
 
 '''
-Create the provider to serve the customers
-
-env - SimPy Enviornment
-arrival - the customer's arrival time to the queue
-prio - the customer's priority
-serv_time - the length of service of the job; randomly generated on arrival
-server - tuple featuring the server resource and the wait time statistic collector
-t_start - time to begin collection of statistics
+Waiting jobs are held in a binary heap stored in a structured array, ordered by class and then by arrival time.
+Within a class the job in service is always the oldest, so a preempted job returns to the head of its class,
+matching a preempted SimPy request whose priority is bumped ahead of its class.
 '''
 
-def provider(env,arrival,prio,serv_time,t_start,server):
-    # continue looping until job complete
-    notDone = True
-    preemptions = 0
-    while notDone:
-        # yield until the server is available, request with specifed priority
-        with server.processor.request(priority=prio) as MyTurn:
-            yield MyTurn
-            # customer has aquired the server, run job for specified service time
-            start = env.now
-            try:
-                yield env.timeout(serv_time)
-                notDone = False # job complete, reverse flag to exit loop
-            except simpy.Interrupt:
-                # process preempted, adjust remaining service time by how much longer job has remaining
-                serv_time -= (env.now-start)
-                prio -= 0.0001  #ensure that preempted job has higher priority
-                preemptions += 1 
-
-
-    # Record total system time, if beyond the threshold
-    if (env.now > t_start):
-        tmp = np.int_([1])
-        if prio==0:
-            tmp[0]=0
-        server.wait[tmp[0]] += env.now-arrival
-        server.n[tmp[0]] += 1
-        server.preempt[tmp[0]] += preemptions
-        
-        
+JOB = np.dtype([('prio','i8'),('arr','f8'),('rem','f8'),('pre','i8')])
+WAIT, N, PREEMPT = 0, 1, 2 # columns of the statistic collector, one row per class
+
+@njit(cache=True)
+def heap_less(heap, i, j):
+    if heap[i]['prio'] != heap[j]['prio']:
+        return heap[i]['prio'] < heap[j]['prio']
+    return heap[i]['arr'] < heap[j]['arr']
+
+
+@njit(cache=True)
+def heap_swap(heap, i, j):
+    prio, arr, rem, pre = heap[i]['prio'], heap[i]['arr'], heap[i]['rem'], heap[i]['pre']
+    heap[i]['prio'], heap[i]['arr'], heap[i]['rem'], heap[i]['pre'] = heap[j]['prio'], heap[j]['arr'], heap[j]['rem'], heap[j]['pre']
+    heap[j]['prio'], heap[j]['arr'], heap[j]['rem'], heap[j]['pre'] = prio, arr, rem, pre
+
+
+@njit(cache=True)
+def heap_push(heap, size, prio, arr, rem, pre):
+    if size == len(heap):
+        # heap full, double its capacity
+        grown = np.empty(2*len(heap), dtype=heap.dtype)
+        grown[:size] = heap
+        heap = grown
+    heap[size]['prio'], heap[size]['arr'], heap[size]['rem'], heap[size]['pre'] = prio, arr, rem, pre
+    i = size
+    while i > 0:
+        parent = (i-1)//2
+        if not heap_less(heap, i, parent):
+            break
+        heap_swap(heap, i, parent)
+        i = parent
+    return heap
+
+
+@njit(cache=True)
+def heap_pop(heap, size):
+    # move the last job to the root and sift it down; the popped job is left at index size-1
+    size -= 1
+    heap_swap(heap, 0, size)
+    i = 0
+    while True:
+        child = 2*i+1
+        if child >= size:
+            break
+        if child+1 < size and heap_less(heap, child+1, child):
+            child += 1
+        if not heap_less(heap, child, i):
+            break
+        heap_swap(heap, i, child)
+        i = child
+    return size
 
 
 '''
-Create stream of customers until SIM_TIME reached
+Simulate the preemptive priority queue as a compiled next-event loop
+
+The next PU arrival, next customer arrival, and departure of the job in service are tracked directly; an
+arrival preempts a job of a lower priority class in service. Arrival streams are built beforehand and consumed
+in order.
 
-env - the SimPy Enviornment
-server - tuple featuring the server resource and the wait time statistic collector
-rate - arrival rate passed from loop
+t_su - arrival times of customers
+serv - service times of customers
+t_pu - arrival times of PUs
+serv_in - service times of PUs
+sim_time - length of the simulation
 t_start - time to begin collection of statistics
+stats - statistic collector; total wait, number served, and total preemptions of each class, updated in place
 '''
 
-def arrivals_SU(env, server, rate, t_start):
+@njit(nogil=True, cache=True)
+def simulate(t_su, serv, t_pu, serv_in, sim_time, t_start, stats):
+    heap = np.empty(1024, dtype=JOB)
+    size = 0
+    i_su = 0
+    i_pu = 0
+    next_su = t_su[0] if len(t_su) > 0 else np.inf
+    next_pu = t_pu[0] if len(t_pu) > 0 else np.inf
+    t_dep = np.inf # departure of job in service, infinite while idle
+    busy = False
+    prio, arr, rem, pre = 0, 0.0, 0.0, 0 # job in service
+    start = 0.0 # time the job in service last began service
     while True:
-        yield env.timeout(np.random.exponential(1/rate)) # exponential interarrival rate; 
-        arrival = env.now # mark arrival time
-        priority = 1 # regular customer arrival
-        if K == 1: 
-            serv_time = 1/MU # Special case for Deterministic system
+        now = min(next_pu, next_su, t_dep)
+        if now >= sim_time:
+            break
+        if next_pu == now:
+            # PU arrival
+            new_prio, new_rem = 0, serv_in[i_pu]
+            i_pu += 1
+            next_pu = t_pu[i_pu] if i_pu < len(t_pu) else np.inf
+        elif next_su == now:
+            # customer arrival
+            new_prio, new_rem = 1, serv[i_su]
+            i_su += 1
+            next_su = t_su[i_su] if i_su < len(t_su) else np.inf
         else:
-            serv_time = np.random.gamma(SHAPE,SCALE)
-        env.process(provider(env,arrival,priority,serv_time,t_start,server))   
+            # departure; record total system time, if beyond the threshold
+            if (now > t_start):
+                stats[prio,WAIT] += now-arr
+                stats[prio,N] += 1
+                stats[prio,PREEMPT] += pre
+            if size == 0:
+                busy = False
+                t_dep = np.inf
+            else:
+                size = heap_pop(heap, size)
+                prio, arr, rem, pre = heap[size]['prio'], heap[size]['arr'], heap[size]['rem'], heap[size]['pre']
+                start = now
+                t_dep = now+rem
+            continue
+        if not busy:
+            busy = True
+        elif new_prio < prio:
+            # preempt job in service, adjust remaining service time by how much longer job has remaining
+            heap = heap_push(heap, size, prio, arr, rem-(now-start), pre+1)
+            size += 1
+        else:
+            heap = heap_push(heap, size, new_prio, now, new_rem, 0)
+            size += 1
+            continue
+        # new job takes the server
+        prio, arr, rem, pre = new_prio, now, new_rem, 0
+        start = now
+        t_dep = now+rem
 
 
-def arrivals_PU(env, server, rate, t_start):
-    off_time =0
-    while True:
-        match DIST:
-            case 1:
-                # Gamma
-                on_time = np.random.gamma(SHAPE_ARRIN,SCALE_ARRIN)
-            case 2:
-                # Log-Normal
-                on_time = np.random.lognormal(LN_MEAN,LN_STD)
-            case _:
-                # Default 0, Exponential
-                on_time = np.random.exponential(M1)
-        yield env.timeout(off_time+on_time) # general off time + exponential on time 
-        arrival = env.now # mark arrival time
-        priority = 0 # PU arrival
-        serv_time = abs(np.random.logistic(SHAPE_SERVIN,SCALE_SERVIN)) # logistic distribution includes negative support; handle this by accepting absolute value of drawn value
-        off_time = serv_time
-        env.process(provider(env,arrival,priority,serv_time,t_start,server))   
+'''
+Draw a stream of deviates long enough that their sum covers the simulation
 
+fn - sampling function accepting a size keyword, e.g. rng.exponential
+args - arguments passed through to fn
+mean - approximate mean of the deviates, used to size the initial draw
+sim_time - length of the simulation
+'''
 
+def draw_stream(fn, args, mean, sim_time):
+    size = int(sim_time/mean + 6*(sim_time/mean)**0.5) + 100
+    stream = fn(*args, size=size)
+    while stream.sum() < sim_time:
+        stream = np.concatenate((stream, fn(*args, size=size//10+100)))
+    return stream
 
-'''
-Define supporting structures
-'''
-Server = collections.namedtuple('Server','processor,wait,n,preempt') # define server tuple to pass into arrivals, provider methods
-Mean_Wait = np.zeros((ITERATIONS,NUMLAM,2)) # Mean wait time in the class in each iteration
-Mean_Preempt = np.zeros((ITERATIONS,NUMLAM,2)) # Mean preemptions for each class
 
 '''
-Main Simulator Loop
+Generate all arrivals of the simulation up front, truncated at the end of the simulation
+
+sim_time - length of the simulation
+rate - arrival rate of customers
+rng - random number generator for this simulation
 '''
-for l in range(NUMLAM):
-    for k in range(ITERATIONS):
-        print('Lambda %.3f, Iteration # %d' %(LAM[l],k))
-        # create server elements
-        env = simpy.Environment() # establish SimPy enviornment
-        processor = simpy.PreemptiveResource(env,capacity=1) # M|G|1 server with priorities, can simulate arbitrary M|G|n by updating capacity
-        wait = np.zeros(2)
-        n = np.zeros(2)
-        preemptions = np.zeros(2)
-        rate_PU = LAMBDA_IN
-        rate_SU = LAM[l] # total arrival rate of events (customers or server breakdowns)
-        sim_time = 5266711 # sim over ~2 months worth of arrivals (BOS)
-        # sim_time = 5251917 # sim over ~2 months worth of arrivals (CMX)
-        # sim_time = 5270046 # sim over ~2 months worth of arrivals (FAK)
-        t_start = FRAC*sim_time # time to start collecting statistics at
-        server = Server(processor,wait,n,preemptions)
-        #start simulation
-        env.process(arrivals_PU(env,server,rate_PU,t_start))
-        env.process(arrivals_SU(env,server,rate_SU,t_start))
-        env.run(until=sim_time)
-        # Record average wait in each class
-        Mean_Wait[k,l,0] = wait[0]/n[0]
-        Mean_Preempt[k,l,0] = preemptions[0]/n[0]
-        Mean_Wait[k,l,1] = wait[1]/n[1]
-        Mean_Preempt[k,l,1] = preemptions[1]/n[1]
-
-      
+
+def build_streams(sim_time, rate, rng):
+    # customers arrive with exponential interarrival times
+    t_su = np.cumsum(draw_stream(rng.exponential,(1/rate,),1/rate,sim_time))
+    t_su = t_su[t_su < sim_time]
+    serv = draw_service(rng, len(t_su))
+    # PUs arrive after the previous PU has been served and the next on period has elapsed
+    on = draw_stream(draw_on_times,(rng,),M1,sim_time)
+    # logistic distribution includes negative support; sample the positive part by inverting the CDF above zero
+    u = rng.uniform(CDF0_SERVIN,1,size=len(on))
+    serv_in = SHAPE_SERVIN + SCALE_SERVIN*np.log(u/(1-u))
+    gaps = on.copy()
+    gaps[1:] += serv_in[:-1] # initial arrival in period is not preceeded by PU interruption
+    t_pu = np.cumsum(gaps)
+    t_pu = t_pu[t_pu < sim_time]
+    return t_su, serv, t_pu, serv_in[:len(t_pu)]
+
 
 '''
-Compute Statistics     
+Run a single independent simulation; dispatched to worker threads, as the compiled kernel releases the GIL
+
+task - tuple of the index of the arrival rate, the iteration number, and the seed of the random number generator
 '''
+
+def run_one(task):
+    l, k, seed = task
+    print('Lambda %.3f, Iteration # %d' %(LAM[l],k))
+    rng = np.random.default_rng(seed) # independent stream for each simulation
+    rate_SU = LAM[l] # total arrival rate of events (customers or server breakdowns)
+    sim_time = 5266711 # sim over ~2 months worth of arrivals (BOS)
+    # sim_time = 5251917 # sim over ~2 months worth of arrivals (CMX)
+    # sim_time = 5270046 # sim over ~2 months worth of arrivals (FAK)
+    t_start = FRAC*sim_time # time to start collecting statistics at
+    t_su, serv, t_pu, serv_in = build_streams(sim_time,rate_SU,rng)
+    stats = np.zeros((2,3))
+    simulate(t_su,serv,t_pu,serv_in,sim_time,t_start,stats)
+    return l, k, stats[:,WAIT], stats[:,N], stats[:,PREEMPT]
+
+
 '''
-Compute Statistics     
+Sample mean and confidence interval over the independent iterations
+
+X - results of each iteration, along the first axis
+ddof - delta degrees of freedom of the sample standard deviation
 '''
-Sample_Wait = np.mean(Mean_Wait,axis=0) # Sample Mean of the Wait times
-Error = np.std(Mean_Wait, axis=0, ddof=1)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5) # confidence interval
-Sample_Preempt = np.mean(Mean_Preempt,axis=0)
-Err_Preempt = np.std(Mean_Preempt,axis=0)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5)
-# Save results to file
-print('Statistical Results')
-for l in range(NUMLAM):
-    print('At arrival rate %f:' %(LAM[l]))
-    print('Sample Wait time of Class 0 is %.3f with error %.3f.' %(Sample_Wait[l,0],Error[l,0]))
-    print('Sample Wait time of Class 1 is %.3f with error %.3f.' %(Sample_Wait[l,1],Error[l,1]))
-
-with open('eess_data.csv','a', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(Sample_Wait[:,0])
-    writer.writerow(Error[:,0])
-    writer.writerow(Sample_Preempt[:,0])
-    writer.writerow(Err_Preempt[:,0])
-f.close()
-with open('customer_data.csv','a', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(Sample_Wait[:,1])
-    writer.writerow(Error[:,1])
-    writer.writerow(Sample_Preempt[:,1])
-    writer.writerow(Err_Preempt[:,1])
-f.close()
 
+def summarize(X, ddof=0):
+    return np.mean(X,axis=0), np.std(X,axis=0,ddof=ddof)*Z/(ITERATIONS**0.5)
+
+
+if __name__ == '__main__':
+    Mean_Wait = np.zeros((ITERATIONS,NUMLAM,2)) # Mean wait time in the class in each iteration
+    Mean_Preempt = np.zeros((ITERATIONS,NUMLAM,2)) # Mean preemptions for each class
+
+    '''
+    Main Simulator Loop - iterations are independent, so are run in parallel threads across available cores
+    '''
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        # all (rate, iteration) pairs are submitted at once so that workers stay busy across rates
+        pairs = [(l,k) for l in range(NUMLAM) for k in range(ITERATIONS)]
+        # spawn an independent seed for each simulation from the base seed
+        tasks = [(l,k,seed) for (l,k), seed in zip(pairs,np.random.SeedSequence(RSEED).spawn(len(pairs)))]
+        for l, k, wait, n, preemptions in ex.map(run_one, tasks):
+            # Record average wait in each class
+            Mean_Wait[k,l,0] = wait[0]/n[0]
+            Mean_Preempt[k,l,0] = preemptions[0]/n[0]
+            Mean_Wait[k,l,1] = wait[1]/n[1]
+            Mean_Preempt[k,l,1] = preemptions[1]/n[1]
+
+
+    '''
+    Compute Statistics     
+    '''
+    Sample_Wait, Error = summarize(Mean_Wait,ddof=1) # Sample Mean of the Wait times and confidence interval
+    Sample_Preempt, Err_Preempt = summarize(Mean_Preempt)
+    # Save results to file
+    print('Statistical Results')
+    for l in range(NUMLAM):
+        print('At arrival rate %f:' %(LAM[l]))
+        print('Sample Wait time of Class 0 is %.3f with error %.3f.' %(Sample_Wait[l,0],Error[l,0]))
+        print('Sample Wait time of Class 1 is %.3f with error %.3f.' %(Sample_Wait[l,1],Error[l,1]))
+
+    Summary = np.stack([Sample_Wait, Error, Sample_Preempt, Err_Preempt]) # rows written for each class
+    with open('eess_data.csv','ab') as f:
+        np.savetxt(f, Summary[:,:,0], delimiter=',')
+    with open('customer_data.csv','ab') as f:
+        np.savetxt(f, Summary[:,:,1], delimiter=',')
 
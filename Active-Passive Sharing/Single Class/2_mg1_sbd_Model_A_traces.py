@@ -2,7 +2,7 @@
 Simulation of an M|G|1 queue with server breakdowns, modified to accept data from radiometer traces
 Classes are denoted as class 0, and class 1. Class 0 arrivals belong to the higher priority class and
 represent server breakdowns.
-This nomenclature is used to ensure proper sort, as SimPy prioirty resource sorts on priority
+This nomenclature is used to ensure proper sort, as the simulation kernel serves waiting jobs by priority
 in ascending order. This also makes storing system flow time information intuitive, as Python is 
 zero indexed.
 
@@ -12,15 +12,13 @@ changing the service distribution changes the results. In addition, Gamma distri
 SHAPE = 1 corresponds to the Exponential distribution
 """
 
-# import required packages - numpy, scipy, and simpy required to be installed if not present
+# import required packages - numpy and numba required to be installed if not present
 
 import math
 import numpy as np
-import scipy as sp
-import scipy.stats as stats
-import simpy
-import collections
-import csv
+from statistics import NormalDist
+from numba import njit, prange, typed
+import os
 
 '''
 Get input from user for system rate, service rate, and second moment of service. Script expects the input in that order
@@ -43,19 +41,21 @@ MU_IN = 0.0247 #rate at which server gets repaired
 FM_EFF = (1/MU)*(1+LAMBDA_IN/MU_IN) #Effective First Moment of Service Time (cf Eq. 9 in https://ieeexplore.ieee.org/abstract/document/6776591)
 MU_EFF = 1/FM_EFF #Effective mean service rate of customers
 
+'''
+Load a trace, converting it once to a .npy file beside the csv so later runs map the binary copy instead of parsing text
+
+name - file name of the trace, without extension
+'''
+
+def load_trace(name):
+    if not os.path.exists(name+'.npy') or os.path.getmtime(name+'.npy') < os.path.getmtime(name+'.csv'):
+        np.save(name+'.npy', np.loadtxt(name+'.csv',delimiter=',',ndmin=1).ravel()) # csv is newer than the cached copy
+    return np.load(name+'.npy', mmap_mode='r') # read-only pages shared by every simulation
+
 # import the csv files of the variables 
-IN_ARRIVALS = [] # technically the lengths of interarrival periods; used to force server to wait specified interarrival time before next arrival
-with open('interArrival.csv',newline='') as f:
-    reader = csv.reader(f,quoting=csv.QUOTE_NONNUMERIC)
-    for row in reader:
-        IN_ARRIVALS.extend(row)
-f.close()
-IN_SERVICE = []
-with open('sweepPeriod.csv',newline='') as f:
-    reader = csv.reader(f,quoting=csv.QUOTE_NONNUMERIC)
-    for row in reader:
-        IN_SERVICE.extend(row)
-f.close()
+# technically the lengths of interarrival periods; used to force server to wait specified interarrival time before next arrival
+IN_ARRIVALS = load_trace('interArrival')
+IN_SERVICE = load_trace('sweepPeriod')
 
 for l in range(NUMLAM):
     if LAM[l] >= MU_EFF:
@@ -67,10 +67,47 @@ for l in range(NUMLAM):
     RHO[l] = LAM[l]/MU_EFF 
 FRAC = 0.1 # fraction of time to wait for before collecting statistics
 ITERATIONS = 30 # number of independent simulations
+RSEED = 1869 # base seed for random number generation
 ALPHA = 0.05 # confidence interval is 100*(1-alpha) percent
+Z = NormalDist().inv_cdf(1-ALPHA/2) # critical value of the confidence interval
 
 
 K = 1.4897 # Service Distribution; defined such that second moment of service is K over MU^2
+'''
+Draw a batch of Gamma deviates with a fixed shape, using the Marsaglia-Tsang method
+
+The constants of the method depend only on the shape, so are computed once for the whole batch. Shapes
+below 1 are drawn at shape+1 and scaled down by U^(1/shape).
+
+rng - random number generator for this simulation
+shape - shape of the Gamma distribution
+scale - scale of the Gamma distribution
+size - number of deviates to draw
+'''
+
+@njit(cache=True)
+def gamma_batch(rng, shape, scale, size):
+    boost = shape < 1
+    a = shape+1 if boost else shape
+    d = a - 1/3
+    c = 1/np.sqrt(9*d)
+    out = np.empty(size)
+    for i in range(size):
+        while True:
+            x = rng.standard_normal()
+            v = 1 + c*x
+            if v <= 0:
+                continue
+            v = v*v*v
+            u = rng.random()
+            if u < 1 - 0.0331*x**4 or np.log(u) < 0.5*x*x + d*(1-v+np.log(v)):
+                break
+        out[i] = d*v*scale
+    if boost:
+        out *= rng.random(size)**(1/shape)
+    return out
+
+
 if K < 1:
     print('K must be at least 1')
     exit()
@@ -78,6 +115,11 @@ if K < 1:
 if K > 1:
     SHAPE = 1/(K-1) # Shape of Gamma Distribution
     SCALE = (K-1)/MU # Scale of Gamma Distribution
+# resolve the customer service time sampler once rather than checking K on every batch; compiled so the kernel can call it
+if K == 1:
+    draw_service = njit(lambda rng, size: np.full(size, 1/MU)) # Special case for Deterministic system
+else:
+    draw_service = njit(lambda rng, size: gamma_batch(rng, SHAPE, SCALE, size))
 
 K_IN = 1.0222 # Service Repair Distribution; defined such that second moment of service is K_IN over MU_IN^2
 if K_IN < 1:
@@ -97,149 +139,270 @@ SM_IN = K_IN/(MU_IN**2) #Second moment of server repair time
 
 
 '''
-Create the provider to serve the customers
+Waiting jobs are held in a binary heap stored in a structured array, ordered by class and then by arrival time.
+Within a class the job in service is always the oldest, so a preempted job returns to the head of its class,
+matching a preempted SimPy request whose priority is bumped ahead of its class.
+'''
+
+JOB = np.dtype([('prio','i8'),('arr','f8'),('rem','f8'),('pre','i8')])
+WAIT, N, PREEMPT = 0, 1, 2 # columns of the statistic collector, one row per class
+
+@njit(cache=True)
+def heap_less(heap, i, j):
+    if heap[i]['prio'] != heap[j]['prio']:
+        return heap[i]['prio'] < heap[j]['prio']
+    return heap[i]['arr'] < heap[j]['arr']
+
+
+@njit(cache=True)
+def heap_swap(heap, i, j):
+    prio, arr, rem, pre = heap[i]['prio'], heap[i]['arr'], heap[i]['rem'], heap[i]['pre']
+    heap[i]['prio'], heap[i]['arr'], heap[i]['rem'], heap[i]['pre'] = heap[j]['prio'], heap[j]['arr'], heap[j]['rem'], heap[j]['pre']
+    heap[j]['prio'], heap[j]['arr'], heap[j]['rem'], heap[j]['pre'] = prio, arr, rem, pre
+
+
+@njit(cache=True)
+def heap_push(heap, size, prio, arr, rem, pre):
+    if size == len(heap):
+        # heap full, double its capacity
+        grown = np.empty(2*len(heap), dtype=heap.dtype)
+        grown[:size] = heap
+        heap = grown
+    heap[size]['prio'], heap[size]['arr'], heap[size]['rem'], heap[size]['pre'] = prio, arr, rem, pre
+    i = size
+    while i > 0:
+        parent = (i-1)//2
+        if not heap_less(heap, i, parent):
+            break
+        heap_swap(heap, i, parent)
+        i = parent
+    return heap
+
+
+@njit(cache=True)
+def heap_pop(heap, size):
+    # move the last job to the root and sift it down; the popped job is left at index size-1
+    size -= 1
+    heap_swap(heap, 0, size)
+    i = 0
+    while True:
+        child = 2*i+1
+        if child >= size:
+            break
+        if child+1 < size and heap_less(heap, child+1, child):
+            child += 1
+        if not heap_less(heap, child, i):
+            break
+        heap_swap(heap, i, child)
+        i = child
+    return size
+
 
-env - SimPy Enviornment
-arrival - the customer's arrival time to the queue
-prio - the customer's priority
-serv_time - the length of service of the job; randomly generated on arrival
-server - tuple featuring the server resource and the wait time statistic collector
-t_start - time to begin collection of statistics
 '''
+Simulate the preemptive priority queue as a compiled next-event loop
+
+The next PU arrival, next customer arrival, and departure of the job in service are tracked directly; an
+arrival preempts a job of a lower priority class in service. Arrival streams are built beforehand and consumed
+in order.
 
-def provider(env,arrival,prio,serv_time,t_start,server):
-    # continue looping until job complete
-    notDone = True
-    preemption = 0
-    while notDone:
-        # yield until the server is available, request with specifed priority
-        with server.processor.request(priority=prio) as MyTurn:
-            yield MyTurn
-            # customer has aquired the server, run job for specified service time
-            start = env.now
-            try:
-                yield env.timeout(serv_time)
-                notDone = False # job complete, reverse flag to exit loop
-            except simpy.Interrupt:
-                # process preempted, adjust remaining service time by how much longer job has remaining
-                serv_time -= (env.now-start)
-                prio -= 0.0001  #ensure that preempted job has higher priority
-                preemption += 1 
-
-    # Record total system time, if beyond the threshold
-    if (env.now > t_start):
-        tmp = np.int_([1])
-        if prio==0:
-            tmp[0]=0
-        server.wait[tmp[0]] += env.now-arrival
-        server.n[tmp[0]] += 1
-        server.preemptions[tmp[0]] += preemption
-        
-
-
-'''
-Create stream of customers until SIM_TIME reached
-
-env - the SimPy Enviornment
-server - tuple featuring the server resource and the wait time statistic collector
-rate - arrival rate passed from loop
+t_su - arrival times of customers
+serv - service times of customers
+t_pu - arrival times of PUs
+serv_in - service times of PUs
+sim_time - length of the simulation
 t_start - time to begin collection of statistics
+stats - statistic collector; total wait, number served, and total preemptions of each class, updated in place
 '''
 
-def arrivals_SU(env, server, rate, t_start):
+@njit(nogil=True, cache=True)
+def simulate(t_su, serv, t_pu, serv_in, sim_time, t_start, stats):
+    heap = np.empty(1024, dtype=JOB)
+    size = 0
+    i_su = 0
+    i_pu = 0
+    next_su = t_su[0] if len(t_su) > 0 else np.inf
+    next_pu = t_pu[0] if len(t_pu) > 0 else np.inf
+    t_dep = np.inf # departure of job in service, infinite while idle
+    busy = False
+    prio, arr, rem, pre = 0, 0.0, 0.0, 0 # job in service
+    start = 0.0 # time the job in service last began service
     while True:
-        yield env.timeout(np.random.exponential(1/rate)) # exponential interarrival rate; 
-        arrival = env.now # mark arrival time
-        priority = 1 # regular customer arrival
-        if K == 1: 
-            serv_time = 1/MU # Special case for Deterministic system
+        now = min(next_pu, next_su, t_dep)
+        if now >= sim_time:
+            break
+        if next_pu == now:
+            # PU arrival
+            new_prio, new_rem = 0, serv_in[i_pu]
+            i_pu += 1
+            next_pu = t_pu[i_pu] if i_pu < len(t_pu) else np.inf
+        elif next_su == now:
+            # customer arrival
+            new_prio, new_rem = 1, serv[i_su]
+            i_su += 1
+            next_su = t_su[i_su] if i_su < len(t_su) else np.inf
+        else:
+            # departure; record total system time, if beyond the threshold
+            if (now > t_start):
+                stats[prio,WAIT] += now-arr
+                stats[prio,N] += 1
+                stats[prio,PREEMPT] += pre
+            if size == 0:
+                busy = False
+                t_dep = np.inf
+            else:
+                size = heap_pop(heap, size)
+                prio, arr, rem, pre = heap[size]['prio'], heap[size]['arr'], heap[size]['rem'], heap[size]['pre']
+                start = now
+                t_dep = now+rem
+            continue
+        if not busy:
+            busy = True
+        elif new_prio < prio:
+            # preempt job in service, adjust remaining service time by how much longer job has remaining
+            heap = heap_push(heap, size, prio, arr, rem-(now-start), pre+1)
+            size += 1
         else:
-            serv_time = np.random.gamma(SHAPE,SCALE)
-        env.process(provider(env,arrival,priority,serv_time,t_start,server))   
+            heap = heap_push(heap, size, new_prio, now, new_rem, 0)
+            size += 1
+            continue
+        # new job takes the server
+        prio, arr, rem, pre = new_prio, now, new_rem, 0
+        start = now
+        t_dep = now+rem
 
 
-def arrivals_PU(env, server, rate, t_start):
-    off_time = 0 # initial arrival in period is not preceeded by PU interruption
-    i = 0
-    while True:
-        #get next arrival
-        on_time = IN_ARRIVALS[i]
-        # get next on period from 
-        yield env.timeout(off_time+on_time) # general off time + exponential on time 
-        arrival = env.now # mark arrival time
-        priority = 0 # PU arrival
-        serv_time = IN_SERVICE[i]
-        off_time = serv_time
-        env.process(provider(env,arrival,priority,serv_time,t_start,server))
-        i = (i+1)%len(IN_SERVICE)   
+'''
+Draw a stream of exponential deviates long enough that their sum covers the simulation
+
+rng - random number generator for this simulation
+mean - mean of the deviates
+sim_time - length of the simulation
+'''
 
+@njit(cache=True)
+def draw_stream(rng, mean, sim_time):
+    size = int(sim_time/mean + 6*(sim_time/mean)**0.5) + 100
+    stream = rng.exponential(mean, size)
+    while stream.sum() < sim_time:
+        stream = np.concatenate((stream, rng.exponential(mean, size//10+100)))
+    return stream
 
 
 '''
-Define supporting structures
+Generate all customer arrivals of the simulation up front, truncated at the end of the simulation
+
+sim_time - length of the simulation
+rate - arrival rate of customers
+rng - random number generator for this simulation
 '''
-Server = collections.namedtuple('Server','processor,wait,n,preemptions') # define server tuple to pass into arrivals, provider methods
-Mean_Wait = np.zeros((ITERATIONS,NUMLAM,2)) # Mean wait time in the class in each iteration
-Mean_Preempt = np.zeros((ITERATIONS,NUMLAM,2)) # Mean preemptions for each class
+
+@njit(cache=True)
+def build_streams(sim_time, rate, rng):
+    # customers arrive with exponential interarrival times
+    t_su = np.cumsum(draw_stream(rng,1/rate,sim_time))
+    t_su = t_su[t_su < sim_time]
+    serv = draw_service(rng, len(t_su))
+    return t_su, serv
+
 
 '''
-Main Simulator Loop
+Build the PU stream from the traces; it does not depend on any random draws, so is built once and shared by every simulation
+
+sim_time - length of the simulation
+in_arrivals - PU on periods from the traces
+in_service - PU sweep periods from the traces
 '''
-for l in range(NUMLAM):
-    for k in range(ITERATIONS):
-        print('Lambda %.3f, Iteration # %d' %(LAM[l],k))
-        # create server elements
-        env = simpy.Environment() # establish SimPy enviornment
-        processor = simpy.PreemptiveResource(env,capacity=1) # M|G|1 server with priorities, can simulate arbitrary M|G|n by updating capacity
-        wait = np.zeros(2)
-        n = np.zeros(2)
-        preempt = np.zeros(2)
-        rate_PU = LAMBDA_IN
-        rate_SU = LAM[l] # total arrival rate of events (customers or server breakdowns)
-        sim_time = 5266711 # sim over ~2 months worth of arrivals (BOS)
-        # sim_time = 5251917 # sim over ~2 months worth of arrivals (CMX)
-        # sim_time = 5270046 # sim over ~2 months worth of arrivals (FAK)
-        t_start = FRAC*sim_time # time to start collecting statistics at
-        server = Server(processor,wait,n,preempt)
-        #start simulation
-        env.process(arrivals_PU(env,server,rate_PU,t_start))
-        env.process(arrivals_SU(env,server,rate_SU,t_start))
-        env.run(until=sim_time)
-        # Record average wait in each class
-        Mean_Wait[k,l,0] = wait[0]/n[0]
-        Mean_Preempt[k,l,0] = preempt[0]/n[0]
-        Mean_Wait[k,l,1] = wait[1]/n[1]
-        Mean_Preempt[k,l,1] = preempt[1]/n[1]
-      
+
+def build_pu_stream(sim_time, in_arrivals, in_service):
+    # PU stream cycles through the traces; PUs arrive after the previous PU has been served and the next on period has elapsed
+    m = len(in_service)
+    in_arrivals = in_arrivals[:m] # the trace is cycled after the last sweep period, so later on periods are never reached
+    reps = int(sim_time//in_arrivals.sum())+1 # passes through the traces needed to cover the simulation
+    on = np.tile(in_arrivals, reps)
+    serv_in = np.tile(in_service, reps)
+    gaps = on.copy()
+    gaps[1:] += serv_in[:-1] # initial arrival in period is not preceeded by PU interruption
+    t_pu = np.cumsum(gaps)
+    t_pu = t_pu[t_pu < sim_time]
+    return t_pu, serv_in[:len(t_pu)]
+
 
 '''
-Compute Statistics     
+Run independent simulations in a single parallel region across available cores
+
+rngs - typed list of random number generators, one per simulation
+rates - arrival rate of customers in each simulation
+sim_time - length of each simulation
+t_start - time to begin collection of statistics
+t_pu - arrival times of PUs, shared by every simulation
+serv_in - service times of PUs
 '''
-Sample_Wait = np.mean(Mean_Wait,axis=0) # Sample Mean of the Wait times
-Error = np.std(Mean_Wait, axis=0, ddof=1)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5) # confidence interval
-Sample_Preempt = np.mean(Mean_Preempt,axis=0)
-Err_Preempt = np.std(Mean_Preempt,axis=0)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5)
-# Save results to file
-print('Statistical Results')
-for l in range(NUMLAM):
-    print('At arrival rate %f:' %(LAM[l]))
-    print('Sample Wait time of Class 0 is %.3f with error %.3f.' %(Sample_Wait[l,0],Error[l,0]))
-    print('Sample Wait time of Class 1 is %.3f with error %.3f.' %(Sample_Wait[l,1],Error[l,1]))
-
-with open('eess_data.csv','a', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(Sample_Wait[:,0])
-    writer.writerow(Error[:,0])
-    writer.writerow(Sample_Preempt[:,0])
-    writer.writerow(Err_Preempt[:,0])
-f.close()
-with open('customer_data.csv','a', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(Sample_Wait[:,1])
-    writer.writerow(Error[:,1])
-    writer.writerow(Sample_Preempt[:,1])
-    writer.writerow(Err_Preempt[:,1])
-f.close()
+
+@njit(parallel=True, cache=True)
+def run_all(rngs, rates, sim_time, t_start, t_pu, serv_in):
+    stats = np.zeros((len(rngs),2,3))
+    for t in prange(len(rngs)):
+        rng = rngs[np.intp(t)] # prange index is unsigned, typed lists are indexed by signed ints
+        t_su, serv = build_streams(sim_time,rates[t],rng)
+        simulate(t_su,serv,t_pu,serv_in,sim_time,t_start,stats[t])
+    return stats
+
+
+'''
+Sample mean and confidence interval over the independent iterations
+
+X - results of each iteration, along the first axis
+ddof - delta degrees of freedom of the sample standard deviation
+'''
+
+def summarize(X, ddof=0):
+    return np.mean(X,axis=0), np.std(X,axis=0,ddof=ddof)*Z/(ITERATIONS**0.5)
+
+
+if __name__ == '__main__':
+    Mean_Wait = np.zeros((ITERATIONS,NUMLAM,2)) # Mean wait time in the class in each iteration
+    Mean_Preempt = np.zeros((ITERATIONS,NUMLAM,2)) # Mean preemptions for each class
+
+    '''
+    Main Simulator Loop - all (rate, iteration) pairs are independent, so are run together in one parallel region across available cores
+    '''
+    sim_time = 5266711 # sim over ~2 months worth of arrivals (BOS)
+    # sim_time = 5251917 # sim over ~2 months worth of arrivals (CMX)
+    # sim_time = 5270046 # sim over ~2 months worth of arrivals (FAK)
+    t_start = FRAC*sim_time # time to start collecting statistics at
+    t_pu, serv_in = build_pu_stream(sim_time,IN_ARRIVALS,IN_SERVICE)
+    tasks = [(l,k) for l in range(NUMLAM) for k in range(ITERATIONS)]
+    # spawn an independent stream for each simulation from the base seed
+    rngs = typed.List([np.random.default_rng(seed) for seed in np.random.SeedSequence(RSEED).spawn(len(tasks))])
+    rates = np.array([LAM[l] for l, k in tasks]) # total arrival rate of events (customers or server breakdowns)
+    print('Running %d simulations' %(len(tasks)))
+    stats = run_all(rngs,rates,sim_time,t_start,t_pu,serv_in)
+    wait, n, preempt = stats[...,WAIT], stats[...,N], stats[...,PREEMPT]
+    for t, (l, k) in enumerate(tasks):
+        # Record average wait in each class
+        Mean_Wait[k,l,0] = wait[t,0]/n[t,0]
+        Mean_Preempt[k,l,0] = preempt[t,0]/n[t,0]
+        Mean_Wait[k,l,1] = wait[t,1]/n[t,1]
+        Mean_Preempt[k,l,1] = preempt[t,1]/n[t,1]
+
+
+    '''
+    Compute Statistics     
+    '''
+    Sample_Wait, Error = summarize(Mean_Wait,ddof=1) # Sample Mean of the Wait times and confidence interval
+    Sample_Preempt, Err_Preempt = summarize(Mean_Preempt)
+    # Save results to file
+    print('Statistical Results')
+    for l in range(NUMLAM):
+        print('At arrival rate %f:' %(LAM[l]))
+        print('Sample Wait time of Class 0 is %.3f with error %.3f.' %(Sample_Wait[l,0],Error[l,0]))
+        print('Sample Wait time of Class 1 is %.3f with error %.3f.' %(Sample_Wait[l,1],Error[l,1]))
+
+    Summary = np.stack([Sample_Wait, Error, Sample_Preempt, Err_Preempt]) # rows written for each class
+    with open('eess_data.csv','ab') as f:
+        np.savetxt(f, Summary[:,:,0], delimiter=',')
+    with open('customer_data.csv','ab') as f:
+        np.savetxt(f, Summary[:,:,1], delimiter=',')
 
 
 
@@ -2,7 +2,7 @@
 Simulation of an M|G|1 queue with server breakdowns, modified to accept data from radiometer traces
 Classes are denoted as class 0, and class 1. Class 0 arrivals belong to the higher priority class and
 represent server breakdowns.
-This nomenclature is used to ensure proper sort, as SimPy prioirty resource sorts on priority
+This nomenclature is used to ensure proper sort, as the simulation kernel serves waiting jobs by priority
 in ascending order. This also makes storing system flow time information intuitive, as Python is 
 zero indexed.
 
@@ -14,15 +14,13 @@ SHAPE = 1 corresponds to the Exponential distribution
 Returns revenue, social welfare of system.
 """
 
-# import required packages - numpy, scipy, and simpy required to be installed if not present
+# import required packages - numpy and numba required to be installed if not present
 
 import math
 import numpy as np
-import scipy as sp
-import scipy.stats as stats
-import simpy
-import collections
-import csv
+from statistics import NormalDist
+from numba import njit, prange, typed
+import os
 
 '''
 Get input from user for system rate, service rate, and second moment of service. Script expects the input in that order
@@ -42,19 +40,21 @@ PHI = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
 NUMPHI = len(PHI)
 Cp = 1 # Cost of Preemption
 
+'''
+Load a trace, converting it once to a .npy file beside the csv so later runs map the binary copy instead of parsing text
+
+name - file name of the trace, without extension
+'''
+
+def load_trace(name):
+    if not os.path.exists(name+'.npy') or os.path.getmtime(name+'.npy') < os.path.getmtime(name+'.csv'):
+        np.save(name+'.npy', np.loadtxt(name+'.csv',delimiter=',',ndmin=1).ravel()) # csv is newer than the cached copy
+    return np.load(name+'.npy', mmap_mode='r') # read-only pages shared by every simulation
+
 # import the csv files of the variables 
-IN_ARRIVALS = [] # technically the lengths of interarrival periods; used to force server to wait specified interarrival time before next arrival
-with open('interArrival.csv',newline='') as f:
-    reader = csv.reader(f,quoting=csv.QUOTE_NONNUMERIC)
-    for row in reader:
-        IN_ARRIVALS.extend(row)
-f.close()
-IN_SERVICE = []
-with open('sweepPeriod.csv',newline='') as f:
-    reader = csv.reader(f,quoting=csv.QUOTE_NONNUMERIC)
-    for row in reader:
-        IN_SERVICE.extend(row)
-f.close()
+# technically the lengths of interarrival periods; used to force server to wait specified interarrival time before next arrival
+IN_ARRIVALS = load_trace('interArrival')
+IN_SERVICE = load_trace('sweepPeriod')
 
 # Define parameters of server breakdowns
 LAMBDA_IN = 0.0003 # (exponential) rate at which server breaks down
@@ -70,7 +70,44 @@ if LAM >= MU_EFF:
 RHO = LAM/MU_EFF # load for each run
 FRAC = 0.1 # fraction of time to wait for before collecting statistics
 ITERATIONS = 30 # number of independent simulations
+RSEED = 1869 # base seed for random number generation
 ALPHA = 0.05 # confidence interval is 100*(1-alpha) percent
+Z = NormalDist().inv_cdf(1-ALPHA/2) # critical value of the confidence interval
+'''
+Draw a batch of Gamma deviates with a fixed shape, using the Marsaglia-Tsang method
+
+The constants of the method depend only on the shape, so are computed once for the whole batch. Shapes
+below 1 are drawn at shape+1 and scaled down by U^(1/shape).
+
+rng - random number generator for this simulation
+shape - shape of the Gamma distribution
+scale - scale of the Gamma distribution
+size - number of deviates to draw
+'''
+
+@njit(cache=True)
+def gamma_batch(rng, shape, scale, size):
+    boost = shape < 1
+    a = shape+1 if boost else shape
+    d = a - 1/3
+    c = 1/np.sqrt(9*d)
+    out = np.empty(size)
+    for i in range(size):
+        while True:
+            x = rng.standard_normal()
+            v = 1 + c*x
+            if v <= 0:
+                continue
+            v = v*v*v
+            u = rng.random()
+            if u < 1 - 0.0331*x**4 or np.log(u) < 0.5*x*x + d*(1-v+np.log(v)):
+                break
+        out[i] = d*v*scale
+    if boost:
+        out *= rng.random(size)**(1/shape)
+    return out
+
+
 if K < 1:
     print('K must be at least 1')
     exit()
@@ -78,148 +115,272 @@ if K < 1:
 if K > 1:
     SHAPE = 1/(K-1) # Shape of Gamma Distribution
     SCALE = (K-1)/MU # Scale of Gamma Distribution
+# resolve the customer service time sampler once rather than checking K on every batch; compiled so the kernel can call it
+if K == 1:
+    draw_service = njit(lambda rng, size: np.full(size, 1/MU)) # Special case for Deterministic system
+else:
+    draw_service = njit(lambda rng, size: gamma_batch(rng, SHAPE, SCALE, size))
   
 
 '''
-Create the provider to serve the customers
+Waiting jobs are held in a binary heap stored in a structured array, ordered by class and then by arrival time.
+Within a class the job in service is always the oldest, so a preempted job returns to the head of its class,
+matching a preempted SimPy request whose priority is bumped ahead of its class.
+'''
+
+JOB = np.dtype([('prio','i8'),('arr','f8'),('rem','f8'),('pre','i8')])
+WAIT, N, PREEMPT = 0, 1, 2 # columns of the statistic collector, one row per class
+
+@njit(cache=True)
+def heap_less(heap, i, j):
+    if heap[i]['prio'] != heap[j]['prio']:
+        return heap[i]['prio'] < heap[j]['prio']
+    return heap[i]['arr'] < heap[j]['arr']
+
+
+@njit(cache=True)
+def heap_swap(heap, i, j):
+    prio, arr, rem, pre = heap[i]['prio'], heap[i]['arr'], heap[i]['rem'], heap[i]['pre']
+    heap[i]['prio'], heap[i]['arr'], heap[i]['rem'], heap[i]['pre'] = heap[j]['prio'], heap[j]['arr'], heap[j]['rem'], heap[j]['pre']
+    heap[j]['prio'], heap[j]['arr'], heap[j]['rem'], heap[j]['pre'] = prio, arr, rem, pre
+
+
+@njit(cache=True)
+def heap_push(heap, size, prio, arr, rem, pre):
+    if size == len(heap):
+        # heap full, double its capacity
+        grown = np.empty(2*len(heap), dtype=heap.dtype)
+        grown[:size] = heap
+        heap = grown
+    heap[size]['prio'], heap[size]['arr'], heap[size]['rem'], heap[size]['pre'] = prio, arr, rem, pre
+    i = size
+    while i > 0:
+        parent = (i-1)//2
+        if not heap_less(heap, i, parent):
+            break
+        heap_swap(heap, i, parent)
+        i = parent
+    return heap
+
+
+@njit(cache=True)
+def heap_pop(heap, size):
+    # move the last job to the root and sift it down; the popped job is left at index size-1
+    size -= 1
+    heap_swap(heap, 0, size)
+    i = 0
+    while True:
+        child = 2*i+1
+        if child >= size:
+            break
+        if child+1 < size and heap_less(heap, child+1, child):
+            child += 1
+        if not heap_less(heap, child, i):
+            break
+        heap_swap(heap, i, child)
+        i = child
+    return size
+
 
-env - SimPy Enviornment
-arrival - the customer's arrival time to the queue
-prio - the customer's priority
-serv_time - the length of service of the job; randomly generated on arrival
-server - tuple featuring the server resource and the wait time statistic collector
-t_start - time to begin collection of statistics
 '''
+Simulate the preemptive priority queue as a compiled next-event loop
 
-def provider(env,arrival,prio,serv_time,t_start,server):
-    # continue looping until job complete
-    notDone = True
-    preemption = 0
-    while notDone:
-        # yield until the server is available, request with specifed priority
-        with server.processor.request(priority=prio) as MyTurn:
-            yield MyTurn
-            # customer has aquired the server, run job for specified service time
-            start = env.now
-            try:
-                yield env.timeout(serv_time)
-                notDone = False # job complete, reverse flag to exit loop
-            except simpy.Interrupt:
-                # process preempted, adjust remaining service time by how much longer job has remaining
-                serv_time -= (env.now-start)
-                prio -= 0.0001  #ensure that preempted job has higher priority
-                preemption += 1 
-
-    # Record total system time, if beyond the threshold
-    if (env.now > t_start):
-        tmp = np.int_(np.ceil(prio))
-        if prio==0:
-            tmp=0
-        server.wait[tmp] += env.now-arrival
-        server.n[tmp] += 1
-        server.preemptions[tmp] += preemption
-        
-
-
-'''
-Create stream of customers until SIM_TIME reached
-
-env - the SimPy Enviornment
-server - tuple featuring the server resource and the wait time statistic collector
-rate - arrival rate passed from loop
+The next PU arrival, next customer arrival, and departure of the job in service are tracked directly; an
+arrival preempts a job of a lower priority class in service. Arrival streams are built beforehand and consumed
+in order.
+
+t_su - arrival times of customers
+serv - service times of customers
+cls - class of each customer
+t_pu - arrival times of PUs
+serv_in - service times of PUs
+sim_time - length of the simulation
 t_start - time to begin collection of statistics
+stats - statistic collector; total wait, number served, and total preemptions of each class, updated in place
 '''
 
-def arrivals_SU(env, server, rate, t_start,phi):
+@njit(nogil=True, cache=True)
+def simulate(t_su, serv, cls, t_pu, serv_in, sim_time, t_start, stats):
+    heap = np.empty(1024, dtype=JOB)
+    size = 0
+    i_su = 0
+    i_pu = 0
+    next_su = t_su[0] if len(t_su) > 0 else np.inf
+    next_pu = t_pu[0] if len(t_pu) > 0 else np.inf
+    t_dep = np.inf # departure of job in service, infinite while idle
+    busy = False
+    prio, arr, rem, pre = 0, 0.0, 0.0, 0 # job in service
+    start = 0.0 # time the job in service last began service
     while True:
-        yield env.timeout(np.random.exponential(1/rate)) # exponential interarrival rate; 
-        arrival = env.now # mark arrival time
-        # random draw for higher vs lower class
-        decision = 1 - np.random.rand()
-        if decision <= phi:
-            priority = 1 # User is Priority class customer
+        now = min(next_pu, next_su, t_dep)
+        if now >= sim_time:
+            break
+        if next_pu == now:
+            # PU arrival
+            new_prio, new_rem = 0, serv_in[i_pu]
+            i_pu += 1
+            next_pu = t_pu[i_pu] if i_pu < len(t_pu) else np.inf
+        elif next_su == now:
+            # customer arrival
+            new_prio, new_rem = cls[i_su], serv[i_su]
+            i_su += 1
+            next_su = t_su[i_su] if i_su < len(t_su) else np.inf
         else:
-            priority = 2 # User is Ordinary class customer
-        if K == 1: 
-            serv_time = 1/MU # Special case for Deterministic system
+            # departure; record total system time, if beyond the threshold
+            if (now > t_start):
+                stats[prio,WAIT] += now-arr
+                stats[prio,N] += 1
+                stats[prio,PREEMPT] += pre
+            if size == 0:
+                busy = False
+                t_dep = np.inf
+            else:
+                size = heap_pop(heap, size)
+                prio, arr, rem, pre = heap[size]['prio'], heap[size]['arr'], heap[size]['rem'], heap[size]['pre']
+                start = now
+                t_dep = now+rem
+            continue
+        if not busy:
+            busy = True
+        elif new_prio < prio:
+            # preempt job in service, adjust remaining service time by how much longer job has remaining
+            heap = heap_push(heap, size, prio, arr, rem-(now-start), pre+1)
+            size += 1
         else:
-            serv_time = np.random.gamma(SHAPE,SCALE)
-        env.process(provider(env,arrival,priority,serv_time,t_start,server))   
+            heap = heap_push(heap, size, new_prio, now, new_rem, 0)
+            size += 1
+            continue
+        # new job takes the server
+        prio, arr, rem, pre = new_prio, now, new_rem, 0
+        start = now
+        t_dep = now+rem
 
 
-def arrivals_PU(env, server, rate, t_start):
-    off_time = 0 # initial arrival in period is not preceeded by PU interruption
-    i = 0
-    while True:
-        #get next arrival
-        on_time = IN_ARRIVALS[i]
-        # get next on period from 
-        yield env.timeout(off_time+on_time) # general off time + exponential on time 
-        arrival = env.now # mark arrival time
-        priority = 0 # PU arrival
-        serv_time = IN_SERVICE[i]
-        off_time = serv_time
-        env.process(provider(env,arrival,priority,serv_time,t_start,server))
-        i = (i+1)%len(IN_SERVICE)   
-
-
-
-'''
-Define supporting structures
-'''
-Server = collections.namedtuple('Server','processor,wait,n,preemptions') # define server tuple to pass into arrivals, provider methods
-Mean_Revenue = np.zeros((ITERATIONS,NUMPHI)) # Mean revenue collected
-Mean_Social = np.zeros((ITERATIONS,NUMPHI)) # Mean Social Welfare of system
-
-'''
-Main Simulator Loop
-'''
-for l in range(NUMPHI):
-    for k in range(ITERATIONS):
-        print('Phi %.1f, Iteration # %d' %(PHI[l],k))
-        # create server elements
-        env = simpy.Environment() # establish SimPy enviornment
-        processor = simpy.PreemptiveResource(env,capacity=1) # M|G|1 server with priorities, can simulate arbitrary M|G|n by updating capacity
-        wait = np.zeros(3)
-        n = np.zeros(3)
-        preempt = np.zeros(3)
-        rate_PU = LAMBDA_IN
-        rate_SU = LAM # total arrival rate of events (customers or server breakdowns)
-        phi = PHI[l] # fraction of customers in higher class
-        sim_time = 2486465 # sim over sample collection period ~1 month in length, in seconds
-        t_start = FRAC*sim_time # time to start collecting statistics at
-        server = Server(processor,wait,n,preempt)
-        #start simulation
-        env.process(arrivals_PU(env,server,rate_PU,t_start))
-        env.process(arrivals_SU(env,server,rate_SU,t_start,phi))
-        env.run(until=sim_time)
-        # Record average wait in each class
-        primary_wait = wait[1]/n[1]
-        primary_preempt = preempt[1]/n[1]
-        secondary_wait = wait[2]/n[2]
-        secondary_preempt = preempt[2]/n[2]
-        # upgrade fee is difference in costs in each class
-        Fee = (secondary_wait - primary_wait) + Cp*(secondary_preempt-primary_preempt)
-        # revenue is defined on expected per time unit basis
-        Mean_Revenue[k,l] = Fee*(n[1]/(sim_time-t_start)) # only consider the period of time during which statistics were actually collected
-        # Social Welfare is weighted average of expected costs in each class
-        Mean_Social[k,l] = (n[1]/(n[1]+n[2]))*(primary_wait+Cp*primary_preempt) + (n[2]/(n[1]+n[2]))*(secondary_wait+Cp*secondary_preempt)
-
-'''
-Compute Statistics     
-'''
-Sample_Revenue = np.mean(Mean_Revenue,axis=0) # Sample mean of Revenues
-Err_Revenue = np.std(Mean_Revenue,axis=0)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5) # confidence interval
-Sample_Social = np.mean(Mean_Social,axis=0)
-Err_Social = np.std(Mean_Social,axis=0)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5)
-# Save results to file
-with open('revenue_data.csv','a', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(Sample_Revenue)
-    writer.writerow(Err_Revenue)
-with open('social_data.csv','a', newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(Sample_Social)
-    writer.writerow(Err_Social)
+'''
+Draw a stream of exponential deviates long enough that their sum covers the simulation
+
+rng - random number generator for this simulation
+mean - mean of the deviates
+sim_time - length of the simulation
+'''
+
+@njit(cache=True)
+def draw_stream(rng, mean, sim_time):
+    size = int(sim_time/mean + 6*(sim_time/mean)**0.5) + 100
+    stream = rng.exponential(mean, size)
+    while stream.sum() < sim_time:
+        stream = np.concatenate((stream, rng.exponential(mean, size//10+100)))
+    return stream
+
+
+'''
+Generate all customer arrivals of the simulation up front, truncated at the end of the simulation
+
+sim_time - length of the simulation
+rate - arrival rate of customers
+phi - fraction of customers in higher class
+rng - random number generator for this simulation
+'''
+
+@njit(cache=True)
+def build_streams(sim_time, rate, phi, rng):
+    # customers arrive with exponential interarrival times
+    t_su = np.cumsum(draw_stream(rng,1/rate,sim_time))
+    t_su = t_su[t_su < sim_time]
+    # random draw for higher vs lower class; Priority class customer is 1, Ordinary class customer is 2
+    cls = np.where(1-rng.random(len(t_su)) <= phi, 1, 2)
+    serv = draw_service(rng, len(t_su))
+    return t_su, serv, cls
+
+
+'''
+Build the PU stream from the traces; it does not depend on any random draws, so is built once and shared by every simulation
+
+sim_time - length of the simulation
+in_arrivals - PU on periods from the traces
+in_service - PU sweep periods from the traces
+'''
+
+def build_pu_stream(sim_time, in_arrivals, in_service):
+    # PU stream cycles through the traces; PUs arrive after the previous PU has been served and the next on period has elapsed
+    m = len(in_service)
+    in_arrivals = in_arrivals[:m] # the trace is cycled after the last sweep period, so later on periods are never reached
+    reps = int(sim_time//in_arrivals.sum())+1 # passes through the traces needed to cover the simulation
+    on = np.tile(in_arrivals, reps)
+    serv_in = np.tile(in_service, reps)
+    gaps = on.copy()
+    gaps[1:] += serv_in[:-1] # initial arrival in period is not preceeded by PU interruption
+    t_pu = np.cumsum(gaps)
+    t_pu = t_pu[t_pu < sim_time]
+    return t_pu, serv_in[:len(t_pu)]
+
+
+'''
+Run independent simulations in a single parallel region across available cores
+
+rngs - typed list of random number generators, one per simulation
+phis - fraction of customers in higher class in each simulation
+sim_time - length of each simulation
+t_start - time to begin collection of statistics
+t_pu - arrival times of PUs, shared by every simulation
+serv_in - service times of PUs
+'''
+
+@njit(parallel=True, cache=True)
+def run_all(rngs, phis, sim_time, t_start, t_pu, serv_in):
+    stats = np.zeros((len(rngs),3,3))
+    for t in prange(len(rngs)):
+        rng = rngs[np.intp(t)] # prange index is unsigned, typed lists are indexed by signed ints
+        t_su, serv, cls = build_streams(sim_time,LAM,phis[t],rng)
+        simulate(t_su,serv,cls,t_pu,serv_in,sim_time,t_start,stats[t])
+    return stats
+
+
+'''
+Sample mean and confidence interval over the independent iterations
+
+X - results of each iteration, along the first axis
+ddof - delta degrees of freedom of the sample standard deviation
+'''
+
+def summarize(X, ddof=0):
+    return np.mean(X,axis=0), np.std(X,axis=0,ddof=ddof)*Z/(ITERATIONS**0.5)
+
+
+if __name__ == '__main__':
+    '''
+    Main Simulator Loop - all (phi, iteration) pairs are independent, so are run together in one parallel region across available cores
+    '''
+    sim_time = 2486465 # sim over sample collection period ~1 month in length, in seconds
+    t_start = FRAC*sim_time # time to start collecting statistics at
+    t_pu, serv_in = build_pu_stream(sim_time,IN_ARRIVALS,IN_SERVICE)
+    tasks = [(l,k) for l in range(NUMPHI) for k in range(ITERATIONS)]
+    # spawn an independent stream for each simulation from the base seed
+    rngs = typed.List([np.random.default_rng(seed) for seed in np.random.SeedSequence(RSEED).spawn(len(tasks))])
+    phis = np.array([PHI[l] for l, k in tasks]) # fraction of customers in higher class
+    print('Running %d simulations' %(len(tasks)))
+    stats = run_all(rngs,phis,sim_time,t_start,t_pu,serv_in)
+    Raw = stats.reshape(NUMPHI,ITERATIONS,3,3).swapaxes(0,1) # indexed by iteration, phi, class, statistic
+    # average wait and preemptions in each class
+    Mean_W = Raw[...,WAIT]/Raw[...,N]
+    Mean_P = Raw[...,PREEMPT]/Raw[...,N]
+    n_primary, n_secondary = Raw[...,1,N], Raw[...,2,N]
+    # upgrade fee is difference in costs in each class
+    Fee = (Mean_W[...,2] - Mean_W[...,1]) + Cp*(Mean_P[...,2]-Mean_P[...,1])
+    # revenue is defined on expected per time unit basis
+    Mean_Revenue = Fee*(n_primary/(sim_time-t_start)) # only consider the period of time during which statistics were actually collected
+    # Social Welfare is weighted average of expected costs in each class
+    Mean_Social = (n_primary/(n_primary+n_secondary))*(Mean_W[...,1]+Cp*Mean_P[...,1]) + (n_secondary/(n_primary+n_secondary))*(Mean_W[...,2]+Cp*Mean_P[...,2])
+
+    '''
+    Compute Statistics     
+    '''
+    Sample_Revenue, Err_Revenue = summarize(Mean_Revenue) # Sample mean of Revenues and confidence interval
+    Sample_Social, Err_Social = summarize(Mean_Social)
+    # Save results to file
+    with open('revenue_data.csv','ab') as f:
+        np.savetxt(f, np.vstack([Sample_Revenue, Err_Revenue]), delimiter=',')
+    with open('social_data.csv','ab') as f:
+        np.savetxt(f, np.vstack([Sample_Social, Err_Social]), delimiter=',')
 
 
@@ -21,17 +21,199 @@ The simulator measures the wait times for each class as well as the number of pr
 
 # import required packages - numpy, scipy, and simpy required to be installed if not present
 
-import math
 import numpy as np
 import simpy
 import os
-import scipy as sp
 import scipy.stats as stats
-import sys
-import csv
+import multiprocessing
+from heapq import heappush, heappop
 
+CHUNK = 65536 # number of random deviates drawn per batch
 
-def Simulator(LAM, MU, PHI, K, LAMi, MUi, Ki, CAPACITY, incumbentfile, priorityfile, generalfile):
+
+'''
+Define Priority Queue class
+Taken from SO article: https://stackoverflow.com/questions/19745116/python-implementing-a-priority-queue
+'''
+class PriorityQueue:
+	def __init__(self):
+		self.items = []
+	
+	'''    
+	push new entries onto the heap
+	Users are defined so that queue sorts first by priroity, then by time joined:
+	priroity = assigned priority (0 for incumbents, 1 for Priority Customers, 2 for General Customers)
+	joined = time the user joined the queue; a preempted user rejoins at the time of preemption, behind waiting users of its class
+	arrival = initial arrival time in system
+	service = remaining service length
+	preemptions = number of times the user has been preempted
+	'''
+	def push(self, priority, joined, arrival, service, preemptions):
+		heappush(self.items, (priority, joined, arrival, service, preemptions))
+	
+	# pop items from the queue, to get next item for processing
+	def pop(self):
+		customer = heappop(self.items)
+		return customer
+
+	# define empty check
+	def empty(self):
+		return not self.items
+
+
+'''
+Create class with resources to manage the queue
+Each of the CAPACITY servers is a provider process serving users popped from a shared priority queue; an arriving user
+wakes an idle server, or preempts the lowest priority user in service if of a higher class
+Parameters are as in Simulator, plus
+SIM_TIME - length of time to run simulation over
+T_START - time to begin collecting statistics, to allow system to reach steady state
+seed - seed of the random number generator of this simulation
+'''
+class SimEnv:
+	def __init__(self, LAM, MU, PHI, K, LAMi, MUi, Ki, CAPACITY, SIM_TIME, T_START, seed):
+		self.SIM_TIME = SIM_TIME
+		# deterministic service times, computed once rather than on every arrival
+		inv_mu, inv_mui = 1/MU, 1/MUi
+		# define parameters of Gamma distribution; Numpy uses shape/scale definition
+		if K > 1:
+			SHAPE = 1/(K-1) 
+			SCALE = (K-1)/MU 
+		if Ki > 1:
+			SHAPEi = 1/(Ki-1)
+			SCALEi = (Ki-1)/MUi
+		rng = np.random.default_rng(seed) # define Generator instance introduced in numpy updates
+		# batched streams of interarrival times and customer priority classes
+		self.cust_iat = self.batched(rng.exponential, 1/LAM)
+		self.inc_iat = self.batched(rng.exponential, 1/LAMi)
+		'''
+		Determine priority classes a batch at a time; roll random numbers between [0,1) 
+		If result is less than PHI, join Priority class (1); otherwise, remain in General (2)
+		'''
+		self.priorities = self.batched(lambda size: np.where(rng.random(size) < PHI, 1, 2))
+		'''
+		Service time samplers, resolved once rather than checking K and Ki on every arrival. Use Gamma Distribution for service times;
+		shape = 1 (K = 2) is special case of Exponential distribution. SHAPE and SCALE are defined such that First moment of service is 1/MU,
+		and second moment is K/MU^2. Gamma is not defined for shape, scale <= 0, so instead have hardcoded special case for deterministic
+		'''
+		if K == 1:
+			self.draw_cust = lambda: inv_mu # Special case for Deterministic system
+		else:
+			cust_serv = self.batched(rng.gamma, SHAPE, SCALE)
+			self.draw_cust = lambda: next(cust_serv)
+		if Ki == 1:
+			self.draw_inc = lambda: inv_mui # Special case for Deterministic system
+		else:
+			inc_serv = self.batched(rng.gamma, SHAPEi, SCALEi)
+			self.draw_inc = lambda: next(inc_serv)
+		self.env = env = simpy.Environment() # establish SimPy enviornment
+		self.w = [0.0, 0.0, 0.0] # collect wait times for each class; plain lists are cheaper to update than numpy arrays
+		self.n = [0, 0, 0] # collect number of users in each class
+		self.p = [0, 0, 0] # collect number of preemptions in each class
+		self.t_start = T_START # time to begin collecting statistics to allow system to reach steady state
+		self.q = PriorityQueue() # priority heap queue shared by the servers
+		self.idle = [True]*CAPACITY # flags to trigger server activation
+		self.users = [None]*CAPACITY # priority and time joined of the user in service at each server
+		self.server_wakeup = [env.event() for c in range(CAPACITY)] # event triggers to wake up idle servers
+		self.prov_proc = [env.process(self.provider(c)) for c in range(CAPACITY)]
+
+	# draw random deviates from the generator in batches of CHUNK, handing them out one at a time
+	def batched(self, draw, *args):
+		while True:
+			yield from draw(*args, size=CHUNK).tolist()
+
+	# establish simulation and run, return relevant statistics
+	def launchSimulation(self):
+		self.env.process(self.custarrivals())
+		self.env.process(self.incarrivals())
+		self.env.run(until=self.SIM_TIME)
+		return np.array(self.w), np.array(self.n), np.array(self.p)
+
+	# hand a newly queued arrival to an idle server, or preempt the lowest priority user in service if the arrival has priority over it
+	def dispatch(self, priority):
+		idle = self.idle
+		if True in idle:
+			c = idle.index(True)
+			idle[c] = False
+			self.server_wakeup[c].succeed() # reactivate server; the server resets the trigger once awake
+		else:
+			# a server woken at this instant has not yet popped its user, and will pop the best one queued; leave it be
+			user = max((u for u in self.users if u is not None), default=None)
+			if user is not None and priority < user[0]:
+				self.prov_proc[self.users.index(user)].interrupt()
+
+	# generate customer arrivals, process in queue
+	def custarrivals(self):
+		env, cust_iat, priorities, draw_cust = self.env, self.cust_iat, self.priorities, self.draw_cust
+		timeout, push, dispatch = env.timeout, self.q.push, self.dispatch # bind methods called on every arrival
+		# want to continue generating customers until SIM_TIME reached
+		while True:
+			# randomized interarrival rate
+			yield timeout(next(cust_iat))
+			# mark arrival time  
+			arrival = env.now 
+			priority = next(priorities) # Priority (1) or Ordinary (2) class customer
+			serv_time = draw_cust() # length of service for customers
+			# Have server process customer arrival
+			push(priority, arrival, arrival, serv_time, 0)
+			dispatch(priority)
+
+	# generate incumbents, process in queue
+	def incarrivals(self):
+		env, inc_iat, draw_inc = self.env, self.inc_iat, self.draw_inc
+		timeout, push, dispatch = env.timeout, self.q.push, self.dispatch # bind methods called on every arrival
+		# want to continue generating customers until SIM_TIME reached
+		while True:
+			# randomized interarrival rate
+			yield timeout(next(inc_iat))
+			# mark arrival time  
+			arrival = env.now 
+			serv_time = draw_inc() # length of service for incumbents
+			# Have server process customer arrival - priority is automatically 0
+			push(0, arrival, arrival, serv_time, 0)
+			dispatch(0)
+
+	# serve arrivals at server c
+	def provider(self, c):
+		env, t_start = self.env, self.t_start
+		timeout, push, pop, empty = env.timeout, self.q.push, self.q.pop, self.q.empty # bind methods called on every service
+		idle, users, w, n, p = self.idle, self.users, self.w, self.n, self.p
+		while True:
+			# if nothing in queue, sleep until next arrival
+			while empty():
+				idle[c] = True
+				users[c] = None
+				yield self.server_wakeup[c] # yield until reactivation event succeeds
+				self.server_wakeup[c] = env.event() # reset server wakeup trigger
+			prio, joined, arr, serv, preemptions = pop() # get next user
+			users[c] = (prio, joined) # kept so arrivals can find the user to preempt
+			idle[c] = False
+			# from now, try serving user for remaining service time
+			start = env.now
+			try:
+				yield timeout(serv)
+				now = env.now
+				# Record total time spent waiting in queue, if beyond the threshold
+				if (now > t_start):
+					w[prio] += now-arr # measuring wait time as total flow time
+					n[prio] += 1
+					p[prio] += preemptions
+			except simpy.Interrupt:
+				# process preempted, adjust remaining service time by how much longer job has remaining; rejoin queue behind its class
+				now = env.now
+				push(prio, now, arr, serv-(now-start), preemptions+1)
+
+
+'''
+Run a single independent simulation; dispatched to worker processes, as each SimPy simulation holds the GIL
+task - tuple of the arguments of SimEnv
+'''
+def run_one(task):
+	Q = SimEnv(*task)
+	return Q.launchSimulation()
+
+
+def Simulator(LAM, MU, PHI, K, LAMi, MUi, Ki, CAPACITY, incumbentout, priorityout, generalout, seed=None):
 	"""
 	Encapsulates the main simulator components, which are then callable by a wrapper to run
 	a suite of simulations for varying scenarios.
@@ -43,9 +225,10 @@ def Simulator(LAM, MU, PHI, K, LAMi, MUi, Ki, CAPACITY, incumbentfile, priorityf
 	MUi - Average service rate of incumbents
 	Ki - Service distribution of incumbents
 	CAPACITY - capacity of the server
-	incumbentfile - file to save off incumbent statistics
-	priorityfile - file to save off priority class statistics
-	generalfile - file to save off general class statistics
+	incumbentout - open binary file handle to save off incumbent statistics
+	priorityout - open binary file handle to save off priority class statistics
+	generalout - open binary file handle to save off general class statistics
+	seed - seed of the random number generators; a fresh seed is drawn from the OS if None
 	"""
 
 
@@ -56,109 +239,8 @@ def Simulator(LAM, MU, PHI, K, LAMi, MUi, Ki, CAPACITY, incumbentfile, priorityf
 	FRAC = 0.05 # fraction of time to wait for before collecting statistics
 	ITERATIONS = 30 # number of independent simulations
 	ALPHA = 0.05 # confidence interval is 100*(1-alpha) percent
-	# define parameters of Gamma distribution; Numpy uses shape/scale definition
-	if K > 1:
-		SHAPE = 1/(K-1) 
-		SCALE = (K-1)/MU 
-	if Ki > 1:
-		SHAPEi = 1/(Ki-1)
-		SCALEi = (Ki-1)/MUi
-
-	'''
-	Create class with resources to manage the queue
-	'''
-	class PriorityQueue:
-		def __init__(self):
-			self.env = simpy.Environment() # establish SimPy enviornment
-			self.server = simpy.PreemptiveResource(self.env,capacity=CAPACITY) # M|G|1 server with priorities, can simulate arbitrary M|G|n by updating capacity
-			self.w = np.zeros(3) # collect wait times for each class
-			self.n = np.zeros(3) # collect number of users in each class
-			self.p = np.zeros(3) # collect number of preemptions in each class
-			self.t_start = FRAC*SIM_TIME # time to begin collecting statistics to allow system to reach steady state
-
-		# establish simulation and run, return relevant statistics
-		def launchSimulation(self):
-			self.env.process(self.custarrivals())
-			self.env.process(self.incarrivals())
-			self.env.run(until=SIM_TIME)
-			return self.w, self.n, self.p
-
-	
-		# generate customer arrivals, process in queue
-		def custarrivals(self):
-			# want to continue generating customers until SIM_TIME reached
-			while True:
-				# randomized interarrival rate
-				yield self.env.timeout(np.random.exponential(1/LAM))
-				# mark arrival time  
-				arrival = self.env.now 
-				'''
-				Determine priority class; use random.rand to roll a random number between (0,1] 
-				If result is less than or equal to PHI, join Priority class; otherwise, remain in General
-				'''
-				decision = 1 - np.random.rand()
-				if decision <= PHI:
-					priority = 1 # User is Priority class customer
-				else:
-					priority = 2 # User is Ordinary class customer
-				'''
-				serv_time - length of service for customers. Use Gamma Distribution for service times; shape = 1 (K = 2) is special case of 
-				Exponential distribution. SHAPE and SCALE are defined such that First moment of service is 1/MU, and second moment is K/MU^2.
-				Gamma is not defined for shape, scale <= 0, so instead have hardcoded special case for deterministic 
-				'''
-				if K == 1: 
-					serv_time = 1/MU # Special case for Deterministic system
-				else:
-					serv_time = np.random.gamma(SHAPE,SCALE)
-				# Have server process customer arrival
-				self.env.process(self.provider(arrival,priority,serv_time))
-
-		# generate incumbents, process in queue
-		def incarrivals(self):
-			# want to continue generating customers until SIM_TIME reached
-			while True:
-				# randomized interarrival rate
-				yield self.env.timeout(np.random.exponential(1/LAMi))
-				# mark arrival time  
-				arrival = self.env.now 
-				'''
-				serv_time - length of service for incumbents. Use Gamma Distribution for service times; shape = 1 (Ki = 2) is special case of 
-				Exponential distribution. SHAPE and SCALE are defined such that First moment of service is 1/MUi, and second moment is Ki/MUi^2.
-				Gamma is not defined for shape, scale <= 0, so instead have hardcoded special case for deterministic 
-				'''
-				if Ki == 1: 
-					serv_time = 1/MUi # Special case for Deterministic system
-				else:
-					serv_time = np.random.gamma(SHAPEi,SCALEi)
-				# Have server process customer arrival - priority is automatically 0
-				self.env.process(self.provider(arrival,0,serv_time))
-
-		# serve arrivals
-		def provider(self,arr,prio,serv):
-			# continue looping until job complete
-			notDone = True
-			preemptions = 0 #count number of preemptions in service
-			while notDone:
-				# yield until the server is available, request with specifed priority
-				with self.server.request(priority=prio) as MyTurn:
-					yield MyTurn
-					# customer has aquired the server, run job for specified service time
-					start = self.env.now
-					try:
-						yield self.env.timeout(serv)
-						notDone = False # job complete, reverse flag to exit loop
-					except simpy.Interrupt:
-						# process preempted, adjust remaining service time by how much longer job has remaining
-						serv -= (self.env.now-start)
-						preemptions += 1
-						print(preemptions)
-
-			# Record total time spent waiting in queue, if beyond the threshold
-			if (self.env.now > self.t_start):
-				self.w[prio] += self.env.now-arr # measuring wait time as total flow time
-				self.n[prio] += 1
-				self.p[prio] += preemptions
-
+	Z = stats.norm.ppf(1-ALPHA/2) # critical value of the confidence interval, computed once for every statistic
+	T_START = FRAC*SIM_TIME # time to begin collecting statistics
 
 	'''
 	Main Simulator Loop
@@ -166,36 +248,25 @@ def Simulator(LAM, MU, PHI, K, LAMi, MUi, Ki, CAPACITY, incumbentfile, priorityf
 	Waits = np.zeros((ITERATIONS,3)) # Per Class mean wait times
 	Nums = np.zeros((ITERATIONS,3)) # Per Class number of users
 	Preemptions = np.zeros((ITERATIONS,3)) # Per Class number of preemptions
-		
-	for k in range(ITERATIONS):
-		# create and launch server
-		Q = PriorityQueue()
-		w, n, p = Q.launchSimulation()
-		# Record statistics, including mean wait time per class
-		Waits[k] = w/n # want the average flow times, not the totals
-		Nums[k] = n
-		Preemptions[k] = p/n # want the average preemption per user
+	# iterations are independent, so are run in parallel processes across available cores, each with its own random stream
+	seeds = np.random.SeedSequence(seed).spawn(ITERATIONS)
+	tasks = [(LAM, MU, PHI, K, LAMi, MUi, Ki, CAPACITY, SIM_TIME, T_START, s) for s in seeds]
+	with multiprocessing.Pool(os.cpu_count()) as pool:
+		for k, (w, n, p) in enumerate(pool.imap(run_one, tasks)):
+			# Record statistics, including mean wait time per class
+			Waits[k] = w/n # want the average flow times, not the totals
+			Nums[k] = n
+			Preemptions[k] = p/n # want the average preemption per user
 	# compute statistics
 	MeanWaits = np.mean(Waits,axis=0) # mean of (average) Wait/Flow times
-	ErrorWaits = np.std(Waits,axis=0)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5) # CI of (average) Wait/Flow Times
+	ErrorWaits = np.std(Waits,axis=0)*Z/(ITERATIONS**0.5) # CI of (average) Wait/Flow Times
 	MeanNums = np.mean(Nums,axis=0) # mean number of users
-	ErrorNums = np.std(Nums,axis=0)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5) # CI of number of users
+	ErrorNums = np.std(Nums,axis=0)*Z/(ITERATIONS**0.5) # CI of number of users
 	MeanPreemptions = np.mean(Preemptions,axis=0) # mean number of preemptions
-	ErrorPreemptions = np.std(Preemptions,axis=0)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5) # CI of number of users
-	# Save off values for later analysis
-	Inc = [MeanWaits[0], ErrorWaits[0], MeanNums[0], ErrorNums[0], MeanPreemptions[0], ErrorPreemptions[0]]
-	PU = [MeanWaits[1], ErrorWaits[1], MeanNums[1], ErrorNums[1], MeanPreemptions[1], ErrorPreemptions[1]]
-	GU = [MeanWaits[2], ErrorWaits[2], MeanNums[2], ErrorNums[2], MeanPreemptions[2], ErrorPreemptions[2]]
-	with open(incumbentfile, 'a') as incout:
-		writer = csv.writer(incout, lineterminator='\n')
-		writer.writerow(Inc)
-	incout.close()
-	with open(priorityfile, 'a') as puout:
-		writer = csv.writer(puout, lineterminator='\n')
-		writer.writerow(PU)
-	puout.close()
-	with open(generalfile, 'a') as guout:
-		writer = csv.writer(guout, lineterminator='\n')
-		writer.writerow(GU)
-	guout.close()
+	ErrorPreemptions = np.std(Preemptions,axis=0)*Z/(ITERATIONS**0.5) # CI of number of users
+	# Save off values for later analysis; row c holds the statistics of class c
+	Summary = np.stack([MeanWaits, ErrorWaits, MeanNums, ErrorNums, MeanPreemptions, ErrorPreemptions], axis=1)
+	for c, statout in enumerate([incumbentout, priorityout, generalout]):
+		np.savetxt(statout, Summary[c:c+1], delimiter=',')
+		statout.flush() # flush so results are kept if the sweep is interrupted
 
@@ -23,18 +23,23 @@ ki = 2 # incumbent service distribution
 c = 1 # capacity of the server
 
 
-for i in range(len(lam)):
-	l = lam[i]
-	for j in range(len(phi)):
-		p = phi[j]
-		# define files and directories to save files
-		workingdir = os.path.dirname(__file__) # absolute path to current directory
-		incfile = os.path.join(workingdir, 'statfilefiles/inc_stats_lambda_{0}.csv'.format(l))
-		os.makedirs(os.path.dirname(incfile), exist_ok = True)
-		pufile = os.path.join(workingdir, 'statfilefiles/pu_stats_lambda_{0}.csv'.format(l))
-		os.makedirs(os.path.dirname(pufile), exist_ok = True)
-		gufile = os.path.join(workingdir, 'statfilefiles/gu_stats_lambda_{0}.csv'.format(l))
-		os.makedirs(os.path.dirname(gufile), exist_ok = True)
-		print('Starting lambda = {0}, phi = {1}'.format(l,p))
-		Simulator(l, mu, p, k, lami, mui, ki, c, incfile, pufile, gufile)
-print('Simulations Complete')
\ No newline at end of file
+# guard the loops, as the simulator starts worker processes which re-import this module on some platforms
+if __name__ == '__main__':
+	# define directory to save files
+	workingdir = os.path.dirname(__file__) # absolute path to current directory
+	statdir = os.path.join(workingdir, 'statfilefiles')
+	os.makedirs(statdir, exist_ok = True)
+
+	for i in range(len(lam)):
+		l = lam[i]
+		# define files to save statistics; only depend on lambda
+		incfile = os.path.join(statdir, 'inc_stats_lambda_{0}.csv'.format(l))
+		pufile = os.path.join(statdir, 'pu_stats_lambda_{0}.csv'.format(l))
+		gufile = os.path.join(statdir, 'gu_stats_lambda_{0}.csv'.format(l))
+		# open files once for every phi of this lambda
+		with open(incfile, 'ab') as incout, open(pufile, 'ab') as puout, open(gufile, 'ab') as guout:
+			for j in range(len(phi)):
+				p = phi[j]
+				print('Starting lambda = {0}, phi = {1}'.format(l,p))
+				Simulator(l, mu, p, k, lami, mui, ki, c, incout, puout, guout)
+	print('Simulations Complete')
\ No newline at end of file
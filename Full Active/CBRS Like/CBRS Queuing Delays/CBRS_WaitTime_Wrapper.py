@@ -23,14 +23,19 @@ mui = 0.0326984 # incumbent service rate
 ki = 1.85499 # incumbent service distribution
 
 
+# define directory to save files
+workingdir = os.path.dirname(__file__) # absolute path to current directory
+costdir = os.path.join(workingdir, 'costfiles')
+os.makedirs(costdir, exist_ok = True)
+
 for i in range(len(lam)):
 	l = lam[i]
-	for j in range(len(phi)):
-		p = phi[j]
-		# define files and directories to save files
-		workingdir = os.path.dirname(__file__) # absolute path to current directory
-		costfile = os.path.join(workingdir, 'costfiles/cost_stats_lambda_{0}.csv'.format(l))
-		os.makedirs(os.path.dirname(costfile), exist_ok = True)
-		print('Starting lambda = {0}, phi = {1}'.format(l,p))
-		Simulator(l, mu, p, k, lami, mui, ki, costfile)
+	# define file to save statistics; only depends on lambda
+	costfile = os.path.join(costdir, 'cost_stats_lambda_{0}.csv'.format(l))
+	# open file once for every phi of this lambda
+	with open(costfile, 'ab') as costout:
+		for j in range(len(phi)):
+			p = phi[j]
+			print('Starting lambda = {0}, phi = {1}'.format(l,p))
+			Simulator(l, mu, p, k, lami, mui, ki, costout)
 print('Simulations Complete')
\ No newline at end of file
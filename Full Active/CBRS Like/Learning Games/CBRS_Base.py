@@ -1,6 +1,6 @@
 """
 Simulation of an M|G|1 queue with three priority classes and preemtive resume behavior
-Uses simpy to dynamically generate events 
+Events are generated by a compiled next-event loop
 
 The classes are:
 Incumbent class - class 0, government users arriving at rate theta*lambda
@@ -18,15 +18,12 @@ changing the service distribution changes the results. In addition, Gamma distri
 SHAPE = 1 corresponds to the Exponential distribution
 """
 
-# import required packages - numpy, scipy, and simpy required to be installed if not present
+# import required packages - numpy and numba required to be installed if not present
 
-import math
 import numpy as np
-import simpy
 import os
-import scipy as sp
-import scipy.stats as stats
 import csv
+from numba import njit
 
 
 '''
@@ -45,13 +42,17 @@ MUi = 1 # Service rate = 1/(first moment of service)
 RHOi = LAMi/MUi # traffic load, used for validation
 Ki = 2 # Service Distribution; defined such that second moment of service = K/MU^2
 
-CAPACITY = 1 # server capacity
+CAPACITY = 1 # server capacity; the event loop models a single server
 SIM_TIME = 5*(10**6)/LAMc # length of time to run simulation over; scales so that ~5,000,000 customers are generated in each round
 C = 0.833333 # Cost to join Premium class
 FRAC = 0.05 # fraction of time to wait for before collecting statistics
 ALPHA = 0.10 # Best Response Update Fraction
 ITERATIONS = 50 # number of rounds to run the game over
+if CAPACITY != 1:
+	print('CAPACITY must be 1; the event loop models a single server')
+	exit()
 # define parameters of Gamma distribution; Numpy uses shape/scale definition
+SHAPEc, SCALEc, SHAPEi, SCALEi = 0.0, 0.0, 0.0, 0.0 # unused by the deterministic case
 if Kc > 1:
 	SHAPEc = 1/(Kc-1) # Shape of Gamma Distribution
 	SCALEc = (Kc-1)/MUc # Scale of Gamma Distribution
@@ -65,102 +66,171 @@ Define output file to write progressive results to
 workingdir = os.getcwd() # absolute path to current directory
 resultout = os.path.join(workingdir, 'results.csv') # create new csv file
 
+'''
+Waiting users are held in a 4-ary heap stored in a structured array of priority, time joined, arrival time and remaining service time.
+Users are sorted by priority, then by the time they (re)joined the queue; a preempted user rejoins behind the users of its class
+already waiting, as a SimPy request made at the time of preemption would.
+'''
+
+USER = np.dtype([('prio','i8'),('joined','f8'),('arr','f8'),('serv','f8')])
+
+@njit(cache=True)
+def heap_less(heap, i, j):
+	if heap[i]['prio'] != heap[j]['prio']:
+		return heap[i]['prio'] < heap[j]['prio']
+	return heap[i]['joined'] < heap[j]['joined']
+
+
+@njit(cache=True)
+def heap_swap(heap, i, j):
+	prio, joined, arr, serv = heap[i]['prio'], heap[i]['joined'], heap[i]['arr'], heap[i]['serv']
+	heap[i]['prio'], heap[i]['joined'], heap[i]['arr'], heap[i]['serv'] = heap[j]['prio'], heap[j]['joined'], heap[j]['arr'], heap[j]['serv']
+	heap[j]['prio'], heap[j]['joined'], heap[j]['arr'], heap[j]['serv'] = prio, joined, arr, serv
+
+
+@njit(cache=True)
+def heap_push(heap, size, prio, joined, arr, serv):
+	if size == len(heap):
+		# heap full, double its capacity
+		grown = np.empty(2*len(heap), dtype=heap.dtype)
+		grown[:size] = heap
+		heap = grown
+	heap[size]['prio'], heap[size]['joined'], heap[size]['arr'], heap[size]['serv'] = prio, joined, arr, serv
+	# sift up; the parent of node i is (i-1)//4
+	i = size
+	while i > 0:
+		parent = (i-1)//4
+		if not heap_less(heap, i, parent):
+			break
+		heap_swap(heap, i, parent)
+		i = parent
+	return heap
+
+
+@njit(cache=True)
+def heap_pop(heap, size):
+	# move the last user to the root and sift it down; the popped user is left at index size-1
+	size -= 1
+	heap_swap(heap, 0, size)
+	i = 0
+	while True:
+		# children of node i are 4*i+1 to 4*i+4; find the smallest
+		first = 4*i+1
+		if first >= size:
+			break
+		child = first
+		for c in range(first+1, min(first+4, size)):
+			if heap_less(heap, c, child):
+				child = c
+		if not heap_less(heap, child, i):
+			break
+		heap_swap(heap, i, child)
+		i = child
+	return size
+
+
+'''
+Run a single simulation as a compiled next-event loop
+The next customer arrival, next incumbent arrival, and departure of the user in service are tracked directly; an arrival
+preempts a user of a lower priority class in service, which rejoins the queue with its remaining service time.
+A preempted user is held aside rather than pushed onto the heap, since it is often the next to be served; it is compared
+with the head of the heap when the server frees up, and only moved onto the heap if another user is preempted ahead of it.
+Service times use the Gamma distribution; shape = 1 (K = 2) is special case of Exponential distribution. Gamma is not defined
+for shape, scale <= 0, so instead have hardcoded special case for deterministic (K = 1)
+phi - probability of a customer purchasing priority
+sim_time - length of time to run simulation over
+t_start - time to start collecting statistics at
+rng - random number generator for this simulation
+heap - backing array of the heap, reused across simulations; returned, as it is replaced if it has to grow
+'''
+
+@njit(cache=True)
+def run_sim(phi, sim_time, t_start, rng, heap):
+	w = np.zeros(3) # collect wait times for each class
+	n = np.zeros(3) # collect number of users in each class
+	size = 0 # heap starts empty; stale entries from the previous simulation are overwritten as users are pushed
+	next_cust = rng.exponential(1/LAMc) # time of next customer arrival
+	next_inc = np.inf # incumbent arrivals are disabled; start from rng.exponential(1/LAMi) to enable them
+	t_dep = np.inf # departure of user in service, infinite while idle
+	busy = False
+	prio, arr, serv = 0, 0.0, 0.0 # user in service
+	start = 0.0 # time the user in service last began service
+	held = False # whether a preempted user is held aside
+	h_prio, h_joined, h_arr, h_serv = 0, 0.0, 0.0, 0.0 # preempted user held aside
+	while True:
+		now = min(next_cust, next_inc, t_dep)
+		if now >= sim_time:
+			break
+		if now == next_inc:
+			# incumbent arrival - priority is automatically 0
+			new_prio = 0
+			new_serv = 1/MUi if Ki == 1 else rng.gamma(SHAPEi,SCALEi)
+			next_inc = now + rng.exponential(1/LAMi)
+		elif now == next_cust:
+			# customer arrival; customer purchases priority with probability phi, otherwise remains in General
+			new_prio = 1 if rng.random() <= phi else 2
+			new_serv = 1/MUc if Kc == 1 else rng.gamma(SHAPEc,SCALEc)
+			next_cust = now + rng.exponential(1/LAMc)
+		else:
+			# departure; record total time spent in system, if beyond the threshold
+			if (now > t_start):
+				w[prio] += now-arr
+				n[prio] += 1
+			if held and (size == 0 or h_prio < heap[0]['prio'] or (h_prio == heap[0]['prio'] and h_joined < heap[0]['joined'])):
+				# preempted user held aside is ahead of the head of the heap
+				held = False
+				prio, arr, serv = h_prio, h_arr, h_serv
+			elif size > 0:
+				size = heap_pop(heap, size)
+				prio, arr, serv = heap[size]['prio'], heap[size]['arr'], heap[size]['serv']
+			else:
+				busy = False
+				t_dep = np.inf
+				continue
+			start = now
+			t_dep = now+serv
+			continue
+		if not busy:
+			busy = True
+		elif new_prio < prio:
+			# preempt user in service, adjust remaining service time by how much longer job has remaining
+			if held and h_prio <= prio:
+				# user already held aside is ahead, so the newly preempted user waits on the heap
+				heap = heap_push(heap, size, prio, now, arr, serv-(now-start))
+				size += 1
+			else:
+				if held:
+					# newly preempted user is ahead, so move the user held aside onto the heap
+					heap = heap_push(heap, size, h_prio, h_joined, h_arr, h_serv)
+					size += 1
+				held = True
+				h_prio, h_joined, h_arr, h_serv = prio, now, arr, serv-(now-start)
+		else:
+			heap = heap_push(heap, size, new_prio, now, now, new_serv)
+			size += 1
+			continue
+		# new arrival takes the server
+		prio, arr, serv = new_prio, now, new_serv
+		start = now
+		t_dep = now+serv
+	return w, n, heap
+
+
 '''
 Create class with resources to manage the queue
 '''
 class PriorityQueue:
-	def __init__(self,PHI):
-		self.env = simpy.Environment() # establish SimPy enviornment
-		self.server = simpy.PreemptiveResource(self.env,capacity=CAPACITY) # M|G|1 server with priorities, can simulate arbitrary M|G|n by updating capacity
+	def __init__(self,PHI,heap):
 		self.phi = PHI # starting beleif of the customers in the current round
-		# Flag whether customers should favor prioirty class or general class if deviating
-		self.w = np.zeros(3) # collect wait times for each class
-		self.n = np.zeros(3) # collect number of users in each class
+		self.heap = heap # heap backing array carried over from the previous round
 		self.generator = np.random.default_rng() # define Generator instance introduced in numpy updates
 		self.t_start = FRAC*SIM_TIME # time to begin collecting statistics to allow system to reach steady state
 
-	# establish simulation and run, return relevant statistics
+	# run simulation, return relevant statistics
 	def launchSimulation(self):
-		self.env.process(self.arrivals())
-		#self.env.process(self.incumbents())
-		self.env.run(until=SIM_TIME)
+		self.w, self.n, self.heap = run_sim(self.phi, SIM_TIME, self.t_start, self.generator, self.heap)
 		return self.w, self.n
 
-	# generate incumbents, process in queue
-	def incumbents(self):
-		# want to continue generating incumbents until SIM_TIME reached
-		while True:
-			# randomized interarrival rate
-			yield self.env.timeout(self.generator.exponential(1/LAMi))
-			# mark arrival time  
-			arrival = self.env.now 
-			priority = 0 # User is incumbant class
-		
-			'''
-			serv_time - length of service. Use Gamma Distribution for service times; shape = 1 (K = 2) is special case of 
-			Exponential distribution. SHAPE and SCALE are defined such that First moment of service is 1/MU, and second moment is K/MU^2.
-			Gamma is not defined for shape, scale <= 0, so instead have hardcoded special case for deterministic 
-			'''
-			if Ki == 1: 
-				serv_time = 1/MUi # Special case for Deterministic system
-			else:
-				serv_time = self.generator.gamma(SHAPEi,SCALEi)
-			# Have server process customer arrival
-			self.env.process(self.provider(arrival,priority,serv_time))
-
-	
-	# generate customers, process in queue
-	def arrivals(self):
-		# want to continue generating customers until SIM_TIME reached
-		while True:
-			# randomized interarrival rate
-			yield self.env.timeout(self.generator.exponential(1/LAMc))
-			# mark arrival time  
-			arrival = self.env.now 
-			'''
-			priority - customer has option to purchase priority, we assume they do so with probability phi 
-			Class 0 is highest prioirty here, to ensure proper sorting of users in SimPy.
-			This is not necessarily typical priority convention.
-			'''
-			if np.random.rand() <= self.phi:
-				priority = 1 # User is Priority class customer
-			else:
-				priority = 2 # User is General class customer
-
-			'''
-			serv_time - length of service for customers. Use Gamma Distribution for service times; shape = 1 (K = 2) is special case of 
-			Exponential distribution. SHAPE and SCALE are defined such that First moment of service is 1/MU, and second moment is K/MU^2.
-			Gamma is not defined for shape, scale <= 0, so instead have hardcoded special case for deterministic 
-			'''
-			if Kc == 1: 
-				serv_time = 1/MUc # Special case for Deterministic system
-			else:
-				serv_time = self.generator.gamma(SHAPEc,SCALEc)
-			# Have server process customer arrival
-			self.env.process(self.provider(arrival,priority,serv_time))
-
-	# serve arrivals
-	def provider(self,arr,prio,serv):
-		# continue looping until job complete 
-		notDone = True
-		service = serv # need original serv time in order to compute wait in queue
-		while notDone:
-			# yield until the server is available, request with specifed priority
-			with self.server.request(priority=prio) as MyTurn:
-				yield MyTurn
-				# customer has aquired the server, run job for specified service time
-				start = self.env.now
-				try:
-					yield self.env.timeout(service)
-					notDone = False # job complete, reverse flag to exit loop 
-				except simpy.Interrupt:
-					# process preempted, adjust remaining service time by how much longer job has remaining
-					service -= (self.env.now-start)
-		# Record total time spent waiting in queue, if beyond the threshold (customers only)
-		if (self.env.now > self.t_start):
-			self.w[prio] += self.env.now-arr # want to measure just the wait time for our purposes, not the total flow time
-			self.n[prio] += 1           
-
 
 def main():
 	PHI = 0.495 # Round 1, customers proceed with initial belief PHI without option to deviate
@@ -168,11 +238,16 @@ def main():
 	'''
 	Main Simulator Loop
 	'''
+	# open file once for the whole game, flush each row so progress is kept if the game is interrupted
+	file = open(resultout,'a')
+	writer = csv.writer(file, lineterminator='\n')
+	heap = np.empty(1024, dtype=USER) # allocate the heap once, keeping any growth for the later rounds
 	for i in range(ITERATIONS):
 		print('Iteration # %d' %(i)) # print to screen for visual indicator that loop is working
 		# create and launch server
-		Q = PriorityQueue(PHI)
+		Q = PriorityQueue(PHI,heap)
 		w, n = Q.launchSimulation()
+		heap = Q.heap
 		# Record statistics, including mean wait time per class
 		#mean_wait_i = w[0]/n[0] # mean_wait of incumbents
 		mean_wait_i = 0
@@ -187,10 +262,9 @@ def main():
 		elif mean_wait_g < mean_wait_p + C:
 			PHI = max(PHI-ALPHA*PHI,0) # general users better off, so premium users incentivised to switch
 		# write current PHI to file to record output for later
-		with open(resultout,'a') as file:
-			writer = csv.writer(file, lineterminator='\n')
-			writer.writerow([PHI_last,mean_wait_i,mean_wait_p,expected_p,mean_wait_g,expected_g])
-		file.close()
+		writer.writerow([PHI_last,mean_wait_i,mean_wait_p,expected_p,mean_wait_g,expected_g])
+		file.flush()
+	file.close()
 
 		
 	
@@ -1,7 +1,7 @@
 """
 Simulation of an M|G|1 queue modeling CBRS, with three priority classes 
 and preemtive resume service.
-Uses simpy to dynamically generate events 
+Events are generated by a compiled next-event loop
 
 The classes are:
 Incumbent class - class 0, government users bypassing the commerical setup
@@ -19,17 +19,13 @@ SHAPE = 1 corresponds to the Exponential distribution
 The simulator measures the expected costs of service
 """
 
-# import required packages - numpy, scipy, and simpy required to be installed if not present
+# import required packages - numpy, scipy, and numba required to be installed if not present
 
-import math
 import numpy as np
-import simpy
 import os
-import scipy as sp
 import scipy.stats as stats
-import sys
 import csv
-import heapq
+from numba import njit, prange, typed
 
 '''
 Customer Parameters for Gamma Distribution
@@ -52,9 +48,161 @@ C = 0.582691 # Cost to join premium queue
 ROUNDS = 50 # number of rounds to play the game over
 ITERATIONS = 30 # number of independent simulations
 ALPHA = 0.05 # Fraction of customers eligible for update
+RSEED = 1869 # base seed for random number generation
+Z = stats.norm.ppf(1-ALPHA/2) # critical value of the confidence interval
 
 
-def Simulator(lam, mu, k, phi, lami, mui, ki):
+'''
+Waiting users are held in a binary heap stored in a structured array of priority, entry time and remaining service time.
+Users are ordered first by priority, then by entry time; a preempted user keeps its entry time, so returns to the head of its class.
+'''
+
+USER = np.dtype([('prio','i8'),('entry','f8'),('serv','f8')])
+
+@njit(cache=True)
+def heap_less(heap, i, j):
+	if heap[i]['prio'] != heap[j]['prio']:
+		return heap[i]['prio'] < heap[j]['prio']
+	return heap[i]['entry'] < heap[j]['entry']
+
+
+@njit(cache=True)
+def heap_swap(heap, i, j):
+	prio, entry, serv = heap[i]['prio'], heap[i]['entry'], heap[i]['serv']
+	heap[i]['prio'], heap[i]['entry'], heap[i]['serv'] = heap[j]['prio'], heap[j]['entry'], heap[j]['serv']
+	heap[j]['prio'], heap[j]['entry'], heap[j]['serv'] = prio, entry, serv
+
+
+@njit(cache=True)
+def heap_push(heap, size, priority, entry, service):
+	if size == len(heap):
+		# heap full, double its capacity
+		grown = np.empty(2*len(heap), dtype=heap.dtype)
+		grown[:size] = heap
+		heap = grown
+	heap[size]['prio'], heap[size]['entry'], heap[size]['serv'] = priority, entry, service
+	# sift up
+	i = size
+	while i > 0:
+		parent = (i-1)//2
+		if not heap_less(heap, i, parent):
+			break
+		heap_swap(heap, i, parent)
+		i = parent
+	return heap
+
+
+@njit(cache=True)
+def heap_pop(heap, size):
+	# move the last user to the root and sift it down; the popped user is left at index size-1
+	size -= 1
+	heap_swap(heap, 0, size)
+	i = 0
+	while True:
+		child = 2*i+1
+		if child >= size:
+			break
+		if child+1 < size and heap_less(heap, child+1, child):
+			child += 1
+		if not heap_less(heap, child, i):
+			break
+		heap_swap(heap, i, child)
+		i = child
+	return size
+
+
+'''
+Run a single simulation as a compiled next-event loop
+The next customer arrival, next incumbent arrival, and departure of the user in service are tracked directly; an arrival
+preempts a user of a lower priority class in service, which rejoins the queue with its remaining service time.
+Service times use the Gamma distribution; shape = 1 (k = 2) is special case of Exponential distribution. Gamma is not defined
+for shape, scale <= 0, so instead have hardcoded special case for deterministic (k = 1)
+lam, mu, k, shape, scale - arrival rate, service rate, service distribution and Gamma parameters of customers
+phi - Probability of choosing Priority over General
+lami, mui, ki, shapei, scalei - arrival rate, service rate, service distribution and Gamma parameters of incumbents
+sim_time - length of time to run simulation over
+t_start - time to start collecting statistics at
+rng - random number generator for this simulation
+'''
+
+@njit(cache=True)
+def run_sim(lam, mu, k, shape, scale, phi, lami, mui, ki, shapei, scalei, sim_time, t_start, rng):
+	w = np.zeros(3) # collect wait times for each class
+	n = np.zeros(3) # collect number of users in each class
+	heap = np.empty(1024, dtype=USER)
+	size = 0
+	# mean interarrival and deterministic service times, computed once rather than on every arrival
+	inv_lam, inv_lami, inv_mu, inv_mui = 1/lam, 1/lami, 1/mu, 1/mui
+	next_cust = rng.exponential(inv_lam)
+	next_inc = rng.exponential(inv_lami)
+	t_dep = np.inf # departure of user in service, infinite while idle
+	busy = False
+	prio, entry, service = 0, 0.0, 0.0 # user in service
+	serv_start = 0.0 # time the user in service last began service
+	while True:
+		now = min(next_cust, next_inc, t_dep)
+		if now >= sim_time:
+			break
+		if next_inc == now:
+			# incumbent arrival - priority is automatically 0
+			new_prio = 0
+			new_service = inv_mui if ki == 1 else rng.gamma(shapei,scalei)
+			next_inc = now + rng.exponential(inv_lami)
+		elif next_cust == now:
+			# customer arrival; roll a random number between [0,1), join Priority class if less than phi, otherwise remain in General
+			new_prio = 1 if rng.random() < phi else 2
+			new_service = inv_mu if k == 1 else rng.gamma(shape,scale)
+			next_cust = now + rng.exponential(inv_lam)
+		else:
+			# departure; record total time spent in system, if beyond the threshold
+			if (now > t_start):
+				w[prio] += now-entry # measuring wait time as total flow time
+				n[prio] += 1
+			if size == 0:
+				busy = False
+				t_dep = np.inf
+			else:
+				size = heap_pop(heap, size)
+				prio, entry, service = heap[size]['prio'], heap[size]['entry'], heap[size]['serv']
+				serv_start = now
+				t_dep = now+service
+			continue
+		if not busy:
+			busy = True
+		elif new_prio < prio:
+			# preempt user in service, adjust remaining service time by how much longer job has remaining
+			heap = heap_push(heap, size, prio, entry, service-(now-serv_start))
+			size += 1
+		else:
+			heap = heap_push(heap, size, new_prio, now, new_service)
+			size += 1
+			continue
+		# new arrival takes the server
+		prio, entry, service = new_prio, now, new_service
+		serv_start = now
+		t_dep = now+service
+	return w, n
+
+
+'''
+Run independent simulations in a single parallel region across available cores
+rngs - typed list of random number generators, one per simulation
+remaining parameters as in run_sim
+'''
+
+@njit(parallel=True, cache=True)
+def run_all(rngs, lam, mu, k, shape, scale, phi, lami, mui, ki, shapei, scalei, sim_time, t_start):
+	w = np.zeros((len(rngs),3))
+	n = np.zeros((len(rngs),3))
+	for t in prange(len(rngs)):
+		rng = rngs[np.intp(t)] # prange index is unsigned, typed lists are indexed by signed ints
+		w_t, n_t = run_sim(lam, mu, k, shape, scale, phi, lami, mui, ki, shapei, scalei, sim_time, t_start, rng)
+		w[t] = w_t
+		n[t] = n_t
+	return w, n
+
+
+def Simulator(lam, mu, k, phi, lami, mui, ki, rngs):
 	"""
 	Encapsulates the main simulator components, which are then callable by a wrapper to run
 	a suite of simulations for varying scenarios.
@@ -65,6 +213,7 @@ def Simulator(lam, mu, k, phi, lami, mui, ki):
 	lami - Average arrival rate of incumbents
 	mui - Average service rate of incumbents
 	ki - Service distribution of incumbents
+	rngs - typed list of random number generators, one per independent simulation; the simulations are run in parallel
 	"""
 
 	"""
@@ -73,6 +222,7 @@ def Simulator(lam, mu, k, phi, lami, mui, ki):
 	SIM_TIME = (5*10**5)/LAM # length of time to run simulation over; scales so that 1,000,000 users are generated
 	FRAC = 0.05 # fraction of time to wait for before collecting statistics
 	T_START = FRAC*SIM_TIME # time to start collecting statistics at
+	shape, scale, shapei, scalei = 0.0, 0.0, 0.0, 0.0 # unused by the deterministic case
 	if k > 1:
 		shape = 1/(k-1)
 		scale = (k-1)/mu
@@ -80,152 +230,20 @@ def Simulator(lam, mu, k, phi, lami, mui, ki):
 		shapei = 1/(ki-1)
 		scalei = (ki-1)/mui
 
-	'''
-	Define Priority Queue class
-	Taken from SO article: https://stackoverflow.com/questions/19745116/python-implementing-a-priority-queue
-	'''
-	class PriorityQueue:
-		def __init__(self):
-			self.items = []
-		
-		'''    
-		push new entries onto the heap
-		Users are defined so that queue sorts first by priroity, then by entry time:
-		priroity = assigned priority (0 for incumbents, 1 for Priority Customers, 2 for General Customers)
-		entry = initial arrival time in system
-		service = remaining service length
-		'''
-		def push(self, priority, entry, service):
-			heapq.heappush(self.items, (priority, entry, service))
-		
-		# pop items from the queue, to get next item for processing
-		def pop(self):
-			customer = heapq.heappop(self.items)
-			return customer
-	
-		# define empty check
-		def empty(self):
-			return not self.items
-
-	
-
-	'''
-	Create class with resources to manage the queue
-	'''
-	class SimEnv:
-		def __init__(self,env):
-			self.env = env
-			self.w = np.zeros(3) # collect wait times for each class
-			self.n = np.zeros(3) # collect number of users in each class
-			self.q = PriorityQueue() # priority heap queue
-			self.idle = True # flag to trigger server activation
-			self.server_wakeup = env.event() # event trigger to wake up idle server
-			# launch processes
-			self.cust_proc = env.process(self.custarrivals(env))
-			self.inc_proc = env.process(self.incarrivals(env))
-			self.prov_proc = env.process(self.provider(env))
-	
-		# generate customer arrivals, process in queue
-		def custarrivals(self, env):
-			# want to continue generating customers until SIM_TIME reached
-			while True:
-				# randomized interarrival rate
-				yield env.timeout(np.random.exponential(1/lam))
-				# mark arrival time  
-				arrival = env.now 
-				'''
-				Determine priority class; use random.rand to roll a random number between (0,1] 
-				If result is less than or equal to PHI, join Priority class; otherwise, remain in General
-				'''
-				decision = 1 - np.random.rand()
-				if decision <= phi:
-					priority = 1 # User is Priority class customer
-				else:
-					priority = 2 # User is Ordinary class customer
-				'''
-				serv_time - length of service for customers. Use Gamma Distribution for service times; shape = 1 (Ki = 2) is special case of 
-				Exponential distribution. SHAPE and SCALE are defined such that First moment of service is 1/MUi, and second moment is Ki/MUi^2.
-				Gamma is not defined for shape, scale <= 0, so instead have hardcoded special case for deterministic 
-				'''
-				if k == 1: 
-					serv_time = 1/mu # Special case for Deterministic system
-				else:
-					serv_time = np.random.gamma(shape,scale)
-				# Have server process customer arrival
-				self.q.push(priority, arrival, serv_time)
-				# if server idle, wake it up
-				if self.idle:
-					self.server_wakeup.succeed() # reactivate server
-					self.server_wakeup = env.event() # reset server wakeup trigger
-				# otherwise, if new arrival has prioirty over customer currently in service, trigger preemption
-				elif priority < self.next[0]:
-					self.prov_proc.interrupt()
-
-		# generate incumbents, process in queue
-		def incarrivals(self,env):
-			# want to continue generating customers until SIM_TIME reached
-			while True:
-				# randomized interarrival rate
-				yield env.timeout(np.random.exponential(1/lami))
-				# mark arrival time  
-				arrival = env.now 
-				'''
-				serv_time - length of service for incumbents. Use Gamma Distribution for service times; shape = 1 (Ki = 2) is special case of 
-				Exponential distribution. SHAPE and SCALE are defined such that First moment of service is 1/MUi, and second moment is Ki/MUi^2.
-				Gamma is not defined for shape, scale <= 0, so instead have hardcoded special case for deterministic 
-				'''
-				if ki == 1: 
-					serv_time = 1/mui # Special case for Deterministic system
-				else:
-					serv_time = np.random.gamma(shapei,scalei)
-				# Have server process incumbent arrival - priority is automatically 0
-				self.q.push(0, arrival, serv_time)
-				# if server idle, wake it up
-				if self.idle:
-					self.server_wakeup.succeed() # reactivate server
-					self.server_wakeup = self.env.event() # reset server wakeup trigger
-				# otherwise, if new arrival has prioirty over customer currently in service, trigger preemption
-				elif self.next[0] > 0:
-					self.prov_proc.interrupt()
-
-		# serve arrivals
-		def provider(self,env):
-			while True:
-				self.idle = True
-				# if nothing in queue, sleep until next arrival
-				if self.q.empty():
-					yield self.server_wakeup # yield until reactivation event succeeds
-				self.next = self.q.pop() # get next user
-				self.idle = False
-				# from now, try serving customer for remaining service time (next[2])
-				serv_start = env.now
-				try:
-					yield env.timeout(self.next[2])
-					# Record total time spent waiting in queue, if beyond the threshold
-					if (env.now > T_START):
-						self.w[self.next[0]] += env.now-self.next[1] # measuring wait time as total flow time
-						self.n[self.next[0]] += 1		
-				except simpy.Interrupt:
-					# process preempted, adjust remaining service time by how much longer job has remaining
-					self.q.push(self.next[0], self.next[1], self.next[2]-(env.now-serv_start))
-				
 	'''
 	Main Simulator Routine
 	'''
-	# create and launch server
-	env = simpy.Environment()
-	sim = SimEnv(env)
-	env.run(until=SIM_TIME)
-	# Return per class system delay for Priority (1) and General (2) classes
-	# Use placeholder values of phi = 0, 1 since otherwise sim.n[i] = 0 for the other class
+	w, n = run_all(rngs, lam, mu, k, shape, scale, phi, lami, mui, ki, shapei, scalei, SIM_TIME, T_START)
+	# Return per class system delay for Priority (1) and General (2) classes in each simulation
+	# Use placeholder values of phi = 0, 1 since otherwise n[i] = 0 for the other class
 	if phi == 0:
-		DelayP = 0
+		DelayP = np.zeros(len(rngs))
 	else:
-		DelayP = (sim.w[1]/sim.n[1])
+		DelayP = (w[:,1]/n[:,1])
 	if phi == 1:
-		DelayG = 0
+		DelayG = np.zeros(len(rngs))
 	else:
-		DelayG = (sim.w[2]/sim.n[2])
+		DelayG = (w[:,2]/n[:,2])
 	return DelayP, DelayG
 
 '''
@@ -234,35 +252,31 @@ Define output file to write progressive results to
 workingdir = os.getcwd() # absolute path to current directory
 resultout = os.path.join(workingdir, 'results.csv') # create new csv file
 
-# write to file
-with open(resultout,'a') as file:
-	writer = csv.writer(file, lineterminator='\n')
-	writer.writerow([PHI,0])
-file.close()
-# Run Action Learning Game
+# open file once for the whole game, flush each row so progress is kept if the game is interrupted
+file = open(resultout,'a')
+writer = csv.writer(file, lineterminator='\n')
+writer.writerow([PHI,0])
+file.flush()
+# Run Action Learning Game; rounds depend on the previous PHI, but the iterations of a round are independent, so are run in parallel
+seeds = np.random.SeedSequence(RSEED) # each spawn yields fresh children, so every round draws new independent streams
 for i in range(ROUNDS):
 	print('Round # %d' %(i))
-	PHIsim = np.zeros((ITERATIONS))
-	for k in range(ITERATIONS):
-		DP, DG = Simulator(LAM, MU, K, PHI, LAMi, MUi, Ki)
-		PP = Vp*RHOi
-		PG = Vp*(RHOi+PHI*RHO)
-		# use placeholder values if phi = 0 or 1, as otherwise there are 0 customers in other class
-		if PHI == 0:
-			DP = 1/(MU*(1-RHOi)) + (Ki*RHOi/MUi+0.001*K*RHO/MU)/(2*(1-RHOi)*(1-(RHOi+0.001*RHO)))
-		if PHI == 1:
-			DG = 1/(MU*(1-(RHOi+0.999*RHO))) + (Ki*RHOi/MUi+K*RHO/MU)/(2*(1-(RHOi+0.999*RHO))*(1-(RHOi+RHO)))
-		# Update PHI
-		if DP + PP + C < DG + PG:
-			# priority better off, increase PHI
-			PHIsim[k] = min(PHI+ALPHA*(1-PHI),1)
-		elif DG + PG < DP + PP + C :
-			# general better off, decrease PHI
-			PHIsim[k] = max(PHI-ALPHA*PHI,0)
-	PHI = np.mean(PHIsim,axis=0)
-	PHIerr = np.std(PHIsim,axis=0)*stats.norm.ppf(1-ALPHA/2)/(ITERATIONS**0.5)
+	rngs = typed.List([np.random.default_rng(seed) for seed in seeds.spawn(ITERATIONS)])
+	DP, DG = Simulator(LAM, MU, K, PHI, LAMi, MUi, Ki, rngs) # per-iteration delay of Priority and General classes
+	PP = Vp*RHOi
+	PG = Vp*(RHOi+PHI*RHO)
+	# use placeholder values if phi = 0 or 1, as otherwise there are 0 customers in other class
+	if PHI == 0:
+		DP[:] = 1/(MU*(1-RHOi)) + (Ki*RHOi/MUi+0.001*K*RHO/MU)/(2*(1-RHOi)*(1-(RHOi+0.001*RHO)))
+	if PHI == 1:
+		DG[:] = 1/(MU*(1-(RHOi+0.999*RHO))) + (Ki*RHOi/MUi+K*RHO/MU)/(2*(1-(RHOi+0.999*RHO))*(1-(RHOi+RHO)))
+	# Update PHI in every iteration at once; increase PHI where priority better off, decrease where general better off
+	PHIsim = np.where(DP + PP + C < DG + PG, PHI+ALPHA*(1-PHI), np.where(DG + PG < DP + PP + C, PHI-ALPHA*PHI, PHI))
+	PHIsim = np.clip(PHIsim,0,1)
+	# PHIsim holds only ITERATIONS values, so reduce with the array methods and keep PHI a plain float for the next round
+	PHI = float(PHIsim.mean())
+	PHIerr = float(PHIsim.std())*Z/(ITERATIONS**0.5)
 	# write to file
-	with open(resultout,'a') as file:
-		writer = csv.writer(file, lineterminator='\n')
-		writer.writerow([PHI,PHIerr])
-	file.close() 
\ No newline at end of file
+	writer.writerow([PHI,PHIerr])
+	file.flush()
+file.close()